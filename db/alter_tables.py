@@ -32,7 +32,12 @@ def main():
         "ALTER TABLE Sentence DROP COLUMN IF EXISTS embedding;",
         f"ALTER TABLE Sentence ADD COLUMN embedding vector({VECTOR_DIM});",
         "ALTER TABLE Related_text DROP COLUMN IF EXISTS embedding;",
+        # truncated copy of the embedding, see create_coarse_embeddings.py
+        "ALTER TABLE Related_text DROP COLUMN IF EXISTS embedding_coarse;",
         f"ALTER TABLE Related_text ADD COLUMN embedding vector({VECTOR_DIM});",
+        # model and text hash of each embedding, see update_tables.py
+        "ALTER TABLE Sentence DROP COLUMN IF EXISTS embedding_model, DROP COLUMN IF EXISTS embedding_text_hash;",
+        "ALTER TABLE Related_text DROP COLUMN IF EXISTS embedding_model, DROP COLUMN IF EXISTS embedding_text_hash;",
     ]
     with conn.cursor() as cur:
         for query in queries:
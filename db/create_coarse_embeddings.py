@@ -0,0 +1,122 @@
+"""
+Stores the first COARSE_DIM dimensions of every related text embedding, normalized again, in
+`related_text.embedding_coarse` and indexes it with HNSW (per source, like create_index_hnsw.py, and globally).
+The model is a Matryoshka model, so this prefix is itself an embedding: the retriever's two-stage mode
+(`RetrieverBySource(coarse_dim=...)`) searches it first and reranks the candidates with the full embedding.
+
+Re-running it only fills the rows embedded since the last run.
+"""
+import os
+import psycopg2
+import psycopg2.extras
+from pgvector.psycopg2 import register_vector
+from dotenv import load_dotenv
+import numpy as np
+from playground.embedders import truncate
+
+BATCH_SIZE = 5000
+MIN_ROW_COUNT = 20000
+
+
+def fill(conn, dim: int):
+    last_id = ""
+    total = 0
+    with conn.cursor() as cur:
+        while True:
+            # keyset pagination over the primary key, so every batch is an index range scan
+            cur.execute(
+                """
+                SELECT related_id, embedding
+                FROM related_text
+                WHERE related_id > %s
+                AND embedding IS NOT NULL
+                AND embedding_coarse IS NULL
+                ORDER BY related_id
+                LIMIT %s
+                """,
+                (last_id, BATCH_SIZE),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            coarse = truncate(np.stack([embedding for _, embedding in rows]), dim)
+            psycopg2.extras.execute_values(
+                cur,
+                f"""
+                UPDATE related_text AS rt
+                SET embedding_coarse = v.embedding_coarse::vector({dim})
+                FROM (VALUES %s) AS v (related_id, embedding_coarse)
+                WHERE rt.related_id = v.related_id
+                """,
+                [(related_id, vec) for (related_id, _), vec in zip(rows, coarse)],
+                page_size=1000,
+            )
+            conn.commit()
+            last_id = rows[-1][0]
+            total += len(rows)
+            print(f"Filled {total} coarse embeddings (up to {last_id})")
+
+
+def create_indexes(conn, ram_limit: str):
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SET maintenance_work_mem = %s;", (ram_limit,))
+        cur.execute(
+            """
+            SELECT source_id, COUNT(*) AS cnt
+            FROM related_text
+            GROUP BY source_id
+            """
+        )
+        for source_id, count in cur.fetchall():
+            if count < MIN_ROW_COUNT:
+                print(
+                    f"Skipping source_id {source_id} with count {count} < {MIN_ROW_COUNT}"
+                )
+                continue
+            print("Creating coarse index for source_id:", source_id)
+            idx_name = f"related_text_coarse_hnsw_cos_src_{source_id}"
+            cur.execute(
+                f"""
+                CREATE INDEX CONCURRENTLY IF NOT EXISTS {idx_name}
+                ON related_text USING hnsw (embedding_coarse vector_cosine_ops)
+                WITH (m = 16, ef_construction = 128)
+                WHERE source_id = %s;
+                """,
+                (source_id,),
+            )
+        print("Creating global coarse index")
+        cur.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS related_text_coarse_hnsw_cos
+            ON related_text USING hnsw (embedding_coarse vector_cosine_ops)
+            WITH (m = 16, ef_construction = 200);
+            """
+        )
+        cur.execute("ANALYZE related_text;")
+
+
+def main():
+    load_dotenv()
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+    register_vector(conn)
+    dim = int(os.getenv("COARSE_DIM", 256))
+
+    with conn.cursor() as cur:
+        cur.execute(
+            f"ALTER TABLE related_text ADD COLUMN IF NOT EXISTS embedding_coarse vector({dim});"
+        )
+    conn.commit()
+    fill(conn, dim)
+    create_indexes(conn, os.getenv("RAM_LIMIT", "8GB"))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
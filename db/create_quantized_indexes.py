@@ -0,0 +1,131 @@
+"""
+Builds HNSW indexes on quantized expressions of `related_text.embedding` (no extra column is stored):
+
+    halfvec   embedding::halfvec(VECTOR_DIM), half precision floats, half the size of the full index
+    binary    binary_quantize(embedding)::bit(VECTOR_DIM), one bit per dimension, searched by hamming distance
+
+Like create_index_hnsw.py, every large source gets its own partial index, plus a global one.
+The retriever uses them with `RetrieverBySource(quantization="halfvec" | "binary")` and reranks the candidates
+with the full-precision embedding, so with `--drop-full` the full-precision HNSW indexes can be dropped.
+Needs pgvector 0.7 or later.
+
+    python db/create_quantized_indexes.py --kind binary
+"""
+import argparse
+import os
+import time
+import psycopg2
+from dotenv import load_dotenv
+
+MIN_ROW_COUNT = 20000
+OPCLASSES = {
+    "halfvec": ("embedding::halfvec({dim})", "halfvec_cosine_ops"),
+    "binary": ("binary_quantize(embedding)::bit({dim})", "bit_hamming_ops"),
+}
+
+
+def index_size(cursor, pattern: str) -> int:
+    cursor.execute(
+        """
+        SELECT COALESCE(SUM(pg_relation_size(indexrelid)), 0)
+        FROM pg_index
+        JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        WHERE pg_class.relname LIKE %s
+        """,
+        (pattern,),
+    )
+    return cursor.fetchone()[0]
+
+
+def create_indexes(cursor, kind: str, dim: int, sources: list[tuple[str, int]]):
+    expression, opclass = OPCLASSES[kind]
+    expression = expression.format(dim=dim)
+    start = time.perf_counter()
+    for source_id, count in sources:
+        if count < MIN_ROW_COUNT:
+            print(f"Skipping source_id {source_id} with count {count} < {MIN_ROW_COUNT}")
+            continue
+        print(f"Creating {kind} index for source_id:", source_id)
+        cursor.execute(
+            f"""
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS related_text_{kind}_hnsw_src_{source_id}
+            ON related_text USING hnsw (({expression}) {opclass})
+            WITH (m = 16, ef_construction = 128)
+            WHERE source_id = %s;
+            """,
+            (source_id,),
+        )
+    print(f"Creating global {kind} index")
+    cursor.execute(
+        f"""
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS related_text_{kind}_hnsw
+        ON related_text USING hnsw (({expression}) {opclass})
+        WITH (m = 16, ef_construction = 200);
+        """
+    )
+    elapsed = time.perf_counter() - start
+    size = index_size(cursor, f"related_text_{kind}_hnsw%")
+    print(f"{kind} indexes: {size / 2**20:.0f} MiB, built in {elapsed:.0f}s")
+
+
+def drop_full_indexes(cursor):
+    cursor.execute(
+        "SELECT relname FROM pg_class WHERE relkind = 'i' AND relname LIKE 'related_text_embed_hnsw_cos%'"
+    )
+    for (name,) in cursor.fetchall():
+        print("Dropping", name)
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--kind", choices=["halfvec", "binary", "all"], default="all")
+    parser.add_argument(
+        "--drop-full",
+        action="store_true",
+        help="drop the full-precision HNSW indexes of related_text afterwards",
+    )
+    args = parser.parse_args()
+    if (
+        args.drop_full
+        and input(
+            "This will drop the full-precision indexes, only the quantized search will be indexed. Are you sure? (y/n): "
+        ).lower()
+        != "y"
+    ):
+        print("Not Confirmed...")
+        return
+
+    load_dotenv()
+    connection = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+    connection.autocommit = True
+    cursor = connection.cursor()
+    dim = int(os.getenv("VECTOR_DIM", 768))
+
+    cursor.execute("SET maintenance_work_mem = %s;", (os.getenv("RAM_LIMIT", "8GB"),))
+    cursor.execute(
+        """
+        SELECT source_id, COUNT(*) AS cnt
+        FROM related_text
+        GROUP BY source_id
+        """
+    )
+    sources = cursor.fetchall()
+    print(f"full precision indexes: {index_size(cursor, 'related_text_embed_hnsw%') / 2**20:.0f} MiB")
+    for kind in OPCLASSES if args.kind == "all" else [args.kind]:
+        create_indexes(cursor, kind, dim, sources)
+    if args.drop_full:
+        drop_full_indexes(cursor)
+    cursor.execute("ANALYZE related_text;")
+    cursor.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
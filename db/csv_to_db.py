@@ -736,30 +736,44 @@ def process_df(
     df[["mv", "tv", "soura", "aya", "size"]] = df["tafsir_id"].str.split(
         "_", expand=True
     )
-    # convert to integers
-    df[["soura", "aya", "size"]] = df[["soura", "aya", "size"]].astype(int)
     # get the source ID from the mv and tv values
     df["source_id"] = df["mv"].astype(str) + "_" + df["tv"].astype(str)
+    # convert to integers
+    df[["mv", "tv", "soura", "aya", "size"]] = df[
+        ["mv", "tv", "soura", "aya", "size"]
+    ].astype(int)
     # divide the tafsir on the sentence level
     df["sentences"] = df["text"].map(to_sentences)
     # explode the sentences column to have one sentence per row
     sentences = df.explode("sentences", ignore_index=True)
     # the ID is the <tafsir_id>_<index>
+    sentences["part_no"] = sentences.groupby("tafsir_id").cumcount()
     sentences["related_text_id"] = (
-        sentences["tafsir_id"]
-        + "_"
-        + sentences.groupby("tafsir_id").cumcount().astype(str)
+        sentences["tafsir_id"] + "_" + sentences["part_no"].astype(str)
     )
     sentences.rename(columns={"sentences": "details"}, inplace=True)
 
     related_rows = sentences[
-        ["related_text_id", "details", "source_id"]
+        [
+            "related_text_id",
+            "details",
+            "source_id",
+            "tafsir_id",
+            "part_no",
+            "mv",
+            "tv",
+            "soura",
+            "aya",
+            "size",
+        ]
     ].values.tolist()
 
     execute_values(
         cursor,
         """
-        INSERT INTO related_text (related_id, details, source_id)
+        INSERT INTO related_text (
+            related_id, details, source_id, tafsir_prefix, part_no, mv, tv, sura, aya, span
+        )
         VALUES %s
         ON CONFLICT (related_id) DO NOTHING
         """,
@@ -767,6 +781,22 @@ def process_df(
         page_size=page_size,
     )
 
+    # the whole paragraph of every tafsir, in part order, so the retriever does not need to rebuild it
+    group_rows = [
+        (tafsir_id, group["source_id"].iloc[0], group["details"].tolist())
+        for tafsir_id, group in sentences.groupby("tafsir_id", sort=False)
+    ]
+    execute_values(
+        cursor,
+        """
+        INSERT INTO related_text_group (tafsir_prefix, source_id, details)
+        VALUES %s
+        ON CONFLICT (tafsir_prefix) DO NOTHING
+        """,
+        group_rows,
+        page_size=page_size,
+    )
+
     relationship_rows = []
     for row in tqdm(sentences.itertuples()):
         # iterate over the sentences and create the relationship rows
@@ -11,17 +11,9 @@ ON related_text (source_id)
 WHERE embedding IS NOT NULL;
 
 
-CREATE INDEX CONCURRENTLY IF NOT EXISTS related_text_group_parts_idx_rx
-ON related_text (
-  (split_part(related_id,'_',1)),
-  (split_part(related_id,'_',2)),
-  (split_part(related_id,'_',3)),
-  (split_part(related_id,'_',4)),
-  (split_part(related_id,'_',5)),
-  ((split_part(related_id,'_',6))::int)
-)
-INCLUDE (related_id, details)
-WHERE related_id ~ '^[0-9]+(_[0-9]+){5}$';
+-- the retriever joins a chunk's verses by sura and aya range
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sentence_secid_sid_btree
+ON sentence (section_id, sentence_id);
 
 CREATE INDEX CONCURRENTLY IF NOT EXISTS relationship_prefix_sid_secid_idx
 ON relationship (related_text_id_prefix, sentence_id, section_id);
@@ -36,6 +28,7 @@ CREATE INDEX CONCURRENTLY IF NOT EXISTS related_text_related_id_btree
 ON related_text (related_id);
 
 ANALYZE related_text;
+ANALYZE related_text_group;
 ANALYZE relationship;
 ANALYZE sentence;
 ANALYZE related_text_source;
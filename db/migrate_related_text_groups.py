@@ -0,0 +1,74 @@
+"""
+Migrates a database loaded before `related_text` had its `tafsir_prefix` and `part_no` columns:
+fills them from `related_id` (<tafsir_prefix>_<part_no>), builds `related_text_group` (the chunks of every
+tafsir paragraph in part order) and drops the regex expression index the sibling join used to need.
+db/csv_to_db.py fills all of this directly for new data.
+
+Works one source at a time and can be re-run, rows that are already migrated are skipped. Re-running it also
+refreshes the paragraphs whose chunks were added or corrected since, so run it after editing `related_text.details`.
+"""
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            ALTER TABLE related_text
+            ADD COLUMN IF NOT EXISTS tafsir_prefix VARCHAR,
+            ADD COLUMN IF NOT EXISTS part_no INT;
+            """
+        )
+        with open("db/tables.sql", "r") as f:
+            cur.execute(f.read())
+        conn.commit()
+
+        cur.execute("SELECT source_id FROM related_text_source ORDER BY source_id")
+        for (source_id,) in cur.fetchall():
+            cur.execute(
+                """
+                UPDATE related_text
+                SET tafsir_prefix = substring(related_id FROM '^(.*)_[0-9]+$'),
+                    part_no = substring(related_id FROM '_([0-9]+)$')::int
+                WHERE source_id = %s
+                AND tafsir_prefix IS NULL
+                """,
+                (source_id,),
+            )
+            updated = cur.rowcount
+            cur.execute(
+                """
+                INSERT INTO related_text_group (tafsir_prefix, source_id, details)
+                SELECT tafsir_prefix, %s, array_agg(details ORDER BY part_no)
+                FROM related_text
+                WHERE source_id = %s
+                GROUP BY tafsir_prefix
+                ON CONFLICT (tafsir_prefix) DO UPDATE SET details = EXCLUDED.details
+                WHERE related_text_group.details IS DISTINCT FROM EXCLUDED.details
+                """,
+                (source_id, source_id),
+            )
+            conn.commit()
+            print(f"Source {source_id}: {updated} chunks, {cur.rowcount} new or refreshed paragraphs")
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        # only served the split_part self join of the old retrieval query
+        cur.execute("DROP INDEX CONCURRENTLY IF EXISTS related_text_group_parts_idx_rx;")
+        cur.execute("ANALYZE related_text;")
+        cur.execute("ANALYZE related_text_group;")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Migrates a database loaded before `related_text` had its typed id columns: parses `related_id`
+(<mv>_<tv>_<sura>_<aya>_<span>_<part_no>) once into the integer columns mv, tv, sura, aya, span and part_no,
+so no query has to `split_part` it anymore, then builds the index of sentence the verse range join
+(`section_id = sura AND sentence_id BETWEEN aya AND aya + span - 1`) looks verses up with.
+db/csv_to_db.py fills these columns directly for new data.
+
+Works one source at a time and can be re-run, rows that are already migrated are skipped.
+"""
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            ALTER TABLE related_text
+            ADD COLUMN IF NOT EXISTS part_no INT,
+            ADD COLUMN IF NOT EXISTS mv INT,
+            ADD COLUMN IF NOT EXISTS tv INT,
+            ADD COLUMN IF NOT EXISTS sura INT,
+            ADD COLUMN IF NOT EXISTS aya INT,
+            ADD COLUMN IF NOT EXISTS span INT;
+            """
+        )
+        conn.commit()
+
+        cur.execute("SELECT source_id FROM related_text_source ORDER BY source_id")
+        for (source_id,) in cur.fetchall():
+            cur.execute(
+                """
+                UPDATE related_text
+                SET mv = split_part(related_id, '_', 1)::int,
+                    tv = split_part(related_id, '_', 2)::int,
+                    sura = split_part(related_id, '_', 3)::int,
+                    aya = split_part(related_id, '_', 4)::int,
+                    span = split_part(related_id, '_', 5)::int,
+                    part_no = split_part(related_id, '_', 6)::int
+                WHERE source_id = %s
+                AND sura IS NULL
+                AND related_id ~ '^[0-9]+(_[0-9]+){5}$'
+                """,
+                (source_id,),
+            )
+            conn.commit()
+            print(f"Source {source_id}: {cur.rowcount} chunks")
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            CREATE INDEX CONCURRENTLY IF NOT EXISTS sentence_secid_sid_btree
+            ON sentence (section_id, sentence_id);
+            """
+        )
+        cur.execute("ANALYZE related_text;")
+        cur.execute("ANALYZE sentence;")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
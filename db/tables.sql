@@ -26,6 +26,24 @@ CREATE TABLE
         related_id VARCHAR PRIMARY KEY,
         details TEXT NOT NULL,
         source_id VARCHAR,
+        -- related_id is <tafsir_prefix>_<part_no>, and tafsir_prefix is <mv>_<tv>_<sura>_<aya>_<span>:
+        -- the chunk explains the `span` verses starting at verse `aya` of sura `sura`
+        tafsir_prefix VARCHAR,
+        part_no INT,
+        mv INT,
+        tv INT,
+        sura INT,
+        aya INT,
+        span INT,
+        FOREIGN KEY (source_id) REFERENCES Related_text_source (source_id)
+    );
+
+-- the chunks of every tafsir paragraph, details[part_no + 1] is the details of chunk <tafsir_prefix>_<part_no>
+CREATE TABLE
+    IF NOT EXISTS related_text_group (
+        tafsir_prefix VARCHAR PRIMARY KEY,
+        source_id VARCHAR,
+        details TEXT[] NOT NULL,
         FOREIGN KEY (source_id) REFERENCES Related_text_source (source_id)
     );
 
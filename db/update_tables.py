@@ -1,4 +1,13 @@
 import os
+import io
+import re
+import json
+import struct
+import itertools
+import argparse
+import queue
+import threading
+import multiprocessing
 import psycopg2
 import psycopg2.extras
 from pgvector.psycopg2 import register_vector
@@ -7,31 +16,94 @@ from sentence_transformers import SentenceTransformer
 import torch
 import numpy as np
 import traceback
+from cachetools import LRUCache
 from random import randint
 from datetime import datetime
 from playground.utils import TextCleaner
+from playground.embedding_store import EmbeddingStore, text_hash
 
 cleaner = TextCleaner()
 load_dotenv()
 model_name = os.environ.get("EMBEDDING_MODEL")
+VECTOR_DIM = int(os.environ.get("VECTOR_DIM", 768))
 
 BATCH_SIZE = 2000
+# texts per forward pass; every pass is padded to its longest text
+ENCODE_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", 32))
 
 
 class Transformer:
     model = None
     device = "cuda" if torch.cuda.is_available() else "cpu"
+    # embedding cache shared with the server (EMBEDDING_CACHE_PATH), None if not configured
+    store: EmbeddingStore = None
+    # token counts of cleaned texts by text hash, so each text is tokenized once per process
+    lengths = LRUCache(maxsize=int(os.environ.get("TOKEN_LENGTH_CACHE_SIZE", 1_000_000)))
 
     @staticmethod
     def load(model_name: str = model_name):
         print(f"Loading model {model_name} on {Transformer.device}...")
         Transformer.model = SentenceTransformer(model_name, device=Transformer.device)
+        if os.environ.get("EMBEDDING_CACHE_PATH"):
+            Transformer.store = EmbeddingStore(
+                os.environ["EMBEDDING_CACHE_PATH"], model_name
+            )
 
     @staticmethod
     def embeddings(texts: list[str]) -> np.ndarray:
         # The SentenceTransformer model handles tokenization and pooling internally
-        texts = [cleaner.cleanText(text) for text in texts]
-        return Transformer.model.encode(texts)
+        # normalized like the query embeddings, so cached vectors are interchangeable (cosine is unaffected)
+        return Transformer.embed_cleaned([cleaner.cleanText(text) for text in texts])
+
+    @staticmethod
+    def embed_cleaned(texts: list[str]) -> np.ndarray:
+        if Transformer.store is None:
+            return Transformer.encode(texts)
+        vectors = Transformer.store.get_many(texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+        if missing:
+            encoded = dict(zip(missing, Transformer.encode(missing)))
+            Transformer.store.put_many(encoded)
+            vectors.update(encoded)
+        return np.stack([vectors[text] for text in texts])
+
+    @staticmethod
+    def token_lengths(texts: list[str]) -> list[int]:
+        """
+        Number of tokens the model sees for each text (after truncation to its max_seq_length)
+        """
+        hashes = [text_hash(text) for text in texts]
+        missing = {h: text for h, text in zip(hashes, texts) if h not in Transformer.lengths}
+        if missing:
+            input_ids = Transformer.model.tokenizer(
+                list(missing.values()),
+                truncation=True,
+                max_length=Transformer.model.max_seq_length,
+            )["input_ids"]
+            for h, ids in zip(missing, input_ids):
+                Transformer.lengths[h] = len(ids)
+        return [Transformer.lengths[h] for h in hashes]
+
+    @staticmethod
+    def encode(texts: list[str]) -> np.ndarray:
+        """
+        Encodes `texts` in forward passes of texts of similar token length, so little of the compute
+        goes to padding, and returns the embeddings in the order of `texts`.
+        (SentenceTransformer.encode only sorts by character count, and only within one call)
+        """
+        order = np.argsort(Transformer.token_lengths(texts), kind="stable")
+        embeddings = np.empty(
+            (len(texts), Transformer.model.get_sentence_embedding_dimension()),
+            dtype=np.float32,
+        )
+        for start in range(0, len(order), ENCODE_BATCH_SIZE):
+            bucket = order[start : start + ENCODE_BATCH_SIZE]
+            embeddings[bucket] = Transformer.model.encode(
+                [texts[i] for i in bucket],
+                normalize_embeddings=True,
+                batch_size=ENCODE_BATCH_SIZE,
+            )
+        return embeddings
 
 
 # class JinaAPIEmbedder:
@@ -74,22 +146,203 @@ class Transformer:
 #         return [item["embedding"] for item in body["data"]]
 
 
+def connect() -> psycopg2.extensions.connection:
+    conn = psycopg2.connect(
+        dbname=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+    )
+    register_vector(conn)
+    return conn
+
+
 def fetch_pending(
-    cursor: psycopg2.extensions.cursor,
+    connection: psycopg2.extensions.connection,
     table: str,
     pk_cols: list[str],
-    text_col: str,
+    columns: list[str],
     limit: int,
+    after: tuple = None,
+    where: str = "embedding IS NULL",
+    until: tuple = None,
 ):
+    """
+    Yields the primary key and `columns` of the rows matching `where` (all rows if None) in primary key order,
+    `limit` at a time, starting after the key `after` and up to the key `until` included.
+    Each batch is a keyset query (`WHERE (pk) > last key`) on the partial index of pending rows (see `ensure_pending_index`),
+    so the last batches are as cheap as the first and rows that are being encoded (not written yet) are not fetched again
+    """
     pk_list = ", ".join(pk_cols)
-    query = f"""
-        SELECT {pk_list}, {text_col}
-          FROM {table}
-         WHERE embedding IS NULL
-         LIMIT {limit}
+    placeholders = ", ".join(["%s"] * len(pk_cols))
+    with connection.cursor() as cursor:
+        while True:
+            conditions = [where] if where else []
+            if after:
+                conditions.append(f"({pk_list}) > ({placeholders})")
+            if until:
+                conditions.append(f"({pk_list}) <= ({placeholders})")
+            query = f"""
+                SELECT {pk_list}, {", ".join(columns)}
+                  FROM {table}
+                 {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                 ORDER BY {pk_list}
+                 LIMIT {limit}
+            """
+            cursor.execute(query, (after or ()) + (until or ()))
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            yield batch
+            after = tuple(batch[-1][: len(pk_cols)])
+
+
+def ensure_columns(connection: psycopg2.extensions.connection, table: str, column: str):
+    """
+    Adds the embedding column `column` of `table` if missing, with its metadata: the model that computed
+    each embedding (`<column>_model`) and the hash of the cleaned text it was computed from (`<column>_text_hash`)
     """
-    cursor.execute(query)
-    return cursor.fetchall()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            ALTER TABLE {table}
+            ADD COLUMN IF NOT EXISTS {column} vector({VECTOR_DIM}),
+            ADD COLUMN IF NOT EXISTS {column}_model VARCHAR,
+            ADD COLUMN IF NOT EXISTS {column}_text_hash VARCHAR
+            """
+        )
+    connection.commit()
+
+
+def derived_columns(
+    connection: psycopg2.extensions.connection, table: str, column: str
+) -> list[str]:
+    """
+    The columns of `table` computed from `column` (the coarse embeddings of create_coarse_embeddings.py),
+    which become stale when it is written again
+    """
+    if column != "embedding":
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = %s AND column_name = 'embedding_coarse'
+            """,
+            (table.lower(),),
+        )
+        return [name for (name,) in cursor.fetchall()]
+
+
+def ensure_pending_index(
+    connection: psycopg2.extensions.connection,
+    table: str,
+    pk_cols: list[str],
+    column: str = "embedding",
+):
+    # only holds the rows without an embedding, so it shrinks as the backfill goes
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {table.lower()}_pending_{column}_idx
+            ON {table} ({", ".join(pk_cols)})
+            WHERE {column} IS NULL
+            """
+        )
+    connection.commit()
+
+
+def checkpoint_name(table: str, column: str, incremental: bool) -> str:
+    # runs of different kinds scan different rows, so they do not share a checkpoint
+    name = table if column == "embedding" else f"{table}.{column}"
+    return f"{name} (incremental)" if incremental else name
+
+
+def load_checkpoint(cursor, table: str) -> tuple | None:
+    """
+    The primary key up to which every pending row of `table` (a `checkpoint_name`) was embedded by an interrupted run, if any
+    """
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+            table_name VARCHAR PRIMARY KEY,
+            last_key TEXT NOT NULL
+        )
+        """
+    )
+    cursor.execute(
+        "SELECT last_key FROM backfill_checkpoint WHERE table_name = %s", (table,)
+    )
+    row = cursor.fetchone()
+    return tuple(json.loads(row[0])) if row else None
+
+
+def save_checkpoint(cursor, table: str, last_key: tuple | None):
+    # written in the transaction of the batch it covers, so it never gets ahead of the embeddings
+    if last_key is None:
+        cursor.execute("DELETE FROM backfill_checkpoint WHERE table_name = %s", (table,))
+        return
+    cursor.execute(
+        """
+        INSERT INTO backfill_checkpoint (table_name, last_key)
+        VALUES (%s, %s)
+        ON CONFLICT (table_name) DO UPDATE SET last_key = EXCLUDED.last_key
+        """,
+        (table, json.dumps(list(last_key))),
+    )
+
+
+# binary COPY encodings of the staging columns, by type OID; anything else is the pgvector embedding
+COPY_ENCODERS = {
+    20: lambda value: struct.pack(">q", value),  # int8
+    23: lambda value: struct.pack(">i", value),  # int4
+    21: lambda value: struct.pack(">h", value),  # int2
+    25: lambda value: value.encode("utf-8"),  # text
+    1043: lambda value: value.encode("utf-8"),  # varchar
+}
+
+
+def encode_vector(vec) -> bytes:
+    # pgvector's binary format: dimensions and an unused int16, then big-endian float32s
+    vec = np.asarray(vec, dtype=">f4")
+    return struct.pack(">HH", len(vec), 0) + vec.tobytes()
+
+
+def copy_binary(rows: list[tuple], type_oids: list[int]) -> io.BytesIO:
+    encoders = [COPY_ENCODERS.get(oid, encode_vector) for oid in type_oids]
+    buffer = io.BytesIO()
+    buffer.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+    field_count = struct.pack(">h", len(type_oids))
+    for row in rows:
+        buffer.write(field_count)
+        for encoder, value in zip(encoders, row):
+            data = encoder(value)
+            buffer.write(struct.pack(">i", len(data)))
+            buffer.write(data)
+    buffer.write(struct.pack(">h", -1))
+    buffer.seek(0)
+    return buffer
+
+
+def staging_table(
+    cursor, table: str, pk_cols: list[str], column: str = "embedding"
+) -> tuple[str, list[int]]:
+    """
+    A temporary (so unlogged and private to this session) table with the primary key, `column` and `<column>_text_hash`
+    columns of `table`, emptied at every commit. Returns its name and its column type OIDs
+    """
+    staging = f"{table.lower()}_{column}_staging"
+    pk_list = ", ".join(pk_cols)
+    cursor.execute(
+        f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging}
+        ON COMMIT DELETE ROWS
+        AS SELECT {pk_list}, {column}, {column}_text_hash FROM {table} WITH NO DATA
+        """
+    )
+    cursor.execute(f"SELECT * FROM {staging} LIMIT 0")
+    return staging, [column.type_code for column in cursor.description]
 
 
 def update_batch(
@@ -98,12 +351,149 @@ def update_batch(
     pk_cols: list[str],
     embeddings: list[list[float]],
     pk_values: list[tuple],
+    hashes: list[str],
+    column: str = "embedding",
+    derived: list[str] = (),
+):
+    """
+    Streams the batch into the staging table with a binary COPY, then applies it with one set-based UPDATE,
+    recording the model and the text hash of every embedding and clearing the `derived` columns
+    """
+    staging, type_oids = staging_table(cursor, table, pk_cols, column)
+    rows = [tuple(pk) + (vec, h) for vec, pk, h in zip(embeddings, pk_values, hashes)]
+    cursor.copy_expert(
+        f"COPY {staging} FROM STDIN WITH (FORMAT binary)", copy_binary(rows, type_oids)
+    )
+    # so the planner sees a small table and looks the rows up by primary key
+    cursor.execute(f"ANALYZE {staging}")
+    join = " AND ".join(f"t.{col} = s.{col}" for col in pk_cols)
+    clear = "".join(f", {name} = NULL" for name in derived)
+    cursor.execute(
+        f"""
+        UPDATE {table} AS t
+        SET {column} = s.{column},
+            {column}_model = %s,
+            {column}_text_hash = s.{column}_text_hash{clear}
+        FROM {staging} AS s
+        WHERE {join}
+        """,
+        (model_name,),
+    )
+
+
+def stamp_rows(cursor, table: str, pk_cols: list[str], column: str, rows: list[tuple]):
+    """
+    Records the current model and the given text hashes, (pk..., hash) rows, for embeddings computed
+    before their metadata was tracked, without encoding them again
+    """
+    join = " AND ".join(f"t.{col} = v.{col}" for col in pk_cols)
+    psycopg2.extras.execute_values(
+        cursor,
+        f"""
+        UPDATE {table} AS t
+        SET {column}_model = v.model, {column}_text_hash = v.text_hash
+        FROM (VALUES %s) AS v ({", ".join(pk_cols)}, model, text_hash)
+        WHERE {join}
+        """,
+        [tuple(row[:-1]) + (model_name, row[-1]) for row in rows],
+        page_size=1000,
+    )
+
+
+def encode_worker(tasks, results, threads: int):
+    """
+    Encoder process: loads its own copy of the model and embeds the (already cleaned) batches from `tasks`
+    until it gets None, which it passes on to the writer
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    Transformer.load(model_name)
+    while True:
+        task = tasks.get()
+        if task is None:
+            results.put(None)
+            return
+        seq, last_key, pk_values, texts, hashes = task
+        embeddings = Transformer.embed_cleaned(texts)
+        results.put((seq, last_key, pk_values, hashes, embeddings))
+
+
+def read_pending(
+    table: str,
+    pk_cols: list[str],
+    text_col: str,
+    batch_size: int,
+    after: tuple | None,
+    tasks,
+    workers: int,
+    errors: list[Exception],
+    column: str = "embedding",
+    incremental: bool = False,
+    stamp: bool = False,
 ):
-    set_clause = "embedding = %s"
-    where_clause = " AND ".join(f"{col} = %s" for col in pk_cols)
-    query = f"UPDATE {table} SET {set_clause} WHERE {where_clause}"
-    params = [[vec] + list(pk) for vec, pk in zip(embeddings, pk_values)]
-    psycopg2.extras.execute_batch(cursor, query, params, page_size=50)
+    """
+    Reader stage: queues the batches to embed (numbered in key order, with the last key scanned for each)
+    for the encoders, then one None per encoder.
+    Rows missing `column` are queued; with `incremental`, every row is scanned and rows whose model or cleaned
+    text hash differ from the current ones are queued too. With `stamp`, embeddings without metadata (computed
+    before it was recorded) are assumed current and stamped instead of being computed again.
+    A scan resumed `after` a key ends with the rows up to that key still missing `column`: rows inserted
+    since the interrupted run, which it had already passed
+    """
+    connection = connect()
+    # every batch is its own short transaction, no snapshot is held for the whole backfill
+    connection.autocommit = True
+    n = len(pk_cols)
+    try:
+        if incremental:
+            columns = [text_col, f"{column} IS NULL", f"{column}_model", f"{column}_text_hash"]
+            pages = fetch_pending(connection, table, pk_cols, columns, batch_size, after, where=None)
+        else:
+            columns = [text_col]
+            pages = fetch_pending(
+                connection, table, pk_cols, columns, batch_size, after, where=f"{column} IS NULL"
+            )
+        if after is not None:
+            # through the pending index, so this costs one query per batch of new rows
+            pages = itertools.chain(
+                pages,
+                fetch_pending(
+                    connection, table, pk_cols, columns, batch_size, where=f"{column} IS NULL", until=after
+                ),
+            )
+        seq = 0
+        pending: list[tuple] = []
+        for page in pages:
+            stamps = []
+            for row in page:
+                text = cleaner.cleanText(row[n])
+                h = text_hash(text)
+                if incremental:
+                    missing, model, stored_hash = row[n + 1 :]
+                    if not missing and model == model_name and stored_hash == h:
+                        continue
+                    if stamp and not missing and model is None:
+                        stamps.append(tuple(row[:n]) + (h,))
+                        continue
+                pending.append((tuple(row[:n]), text, h))
+            if stamps:
+                with connection.cursor() as cursor:
+                    stamp_rows(cursor, table, pk_cols, column, stamps)
+            last_key = tuple(page[-1][:n])
+            if len(pending) >= batch_size:
+                pk_values, texts, hashes = map(list, zip(*pending))
+                tasks.put((seq, last_key, pk_values, texts, hashes))
+                seq += 1
+                pending = []
+        if pending:
+            pk_values, texts, hashes = map(list, zip(*pending))
+            tasks.put((seq, last_key, pk_values, texts, hashes))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        connection.close()
+        for _ in range(workers):
+            tasks.put(None)
 
 
 def process_table(
@@ -111,26 +501,240 @@ def process_table(
     table: str,
     pk_cols: list[str],
     text_col: str,
+    workers: int = 1,
+    threads: int = 0,
+    batch_size: int = BATCH_SIZE,
+    queue_size: int = 4,
+    resume: bool = True,
+    column: str = "embedding",
+    incremental: bool = False,
+    stamp: bool = False,
 ):
+    """
+    Embeds every row of `table` missing an embedding in `column` (or, with `incremental`, whose embedding is stale,
+    see `read_pending`) as a pipeline: a reader thread fetches batches,
+    `workers` encoder processes (each with its own model and `threads` torch threads) embed them,
+    and this thread writes them back, all connected by bounded queues so no stage waits on another.
+    A checkpoint (the key up to which all batches are written) lets an interrupted run resume where it stopped
+    """
+    ensure_columns(connection, table, column)
+    derived = derived_columns(connection, table, column)
+    checkpoint_key = checkpoint_name(table, column, incremental)
     with connection.cursor() as cur:
-        while True:
-            batch = fetch_pending(cur, table, pk_cols, text_col, BATCH_SIZE)
-            if not batch:
-                break
+        after = load_checkpoint(cur, checkpoint_key) if resume else None
+    connection.commit()
+    # incremental runs scan every row, but a resumed one also looks up the new rows it already passed
+    if not incremental or after is not None:
+        ensure_pending_index(connection, table, pk_cols, column)
+    if after is not None:
+        print(f"Resuming `{checkpoint_key}` after {after}")
 
-            pk_values = [tuple(row[: len(pk_cols)]) for row in batch]
-            texts = [row[-1] for row in batch]
-            try:
-                embeddings = Transformer.embeddings(texts)
-            except RuntimeError as e:
-                print(f"Error fetching embeddings: {e}")
-                break
-            update_batch(cur, table, pk_cols, embeddings, pk_values)
-            connection.commit()
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            print(
-                f"[{now}] Updated {len(batch)} rows in `{table}`" + "." * randint(1, 20)
+    # spawn, not fork: CUDA cannot be used in a forked process, and it is the only option on Windows
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue(maxsize=queue_size)
+    results = context.Queue(maxsize=queue_size)
+    encoders = [
+        context.Process(
+            target=encode_worker,
+            args=(tasks, results, threads),
+            name=f"encoder-{i}",
+            daemon=True,
+        )
+        for i in range(workers)
+    ]
+    for encoder in encoders:
+        encoder.start()
+    errors: list[Exception] = []
+    reader = threading.Thread(
+        target=read_pending,
+        args=(table, pk_cols, text_col, batch_size, after, tasks, workers, errors),
+        kwargs=dict(column=column, incremental=incremental, stamp=stamp),
+        name="reader",
+        daemon=True,
+    )
+    reader.start()
+
+    try:
+        finished = 0
+        updated = 0
+        next_seq = 0
+        written: dict[int, tuple] = {}
+        with connection.cursor() as cur:
+            while finished < workers:
+                try:
+                    item = results.get(timeout=5)
+                except queue.Empty:
+                    if any(encoder.exitcode not in (None, 0) for encoder in encoders):
+                        raise RuntimeError("An encoder process died")
+                    continue
+                if item is None:
+                    finished += 1
+                    continue
+                seq, last_key, pk_values, hashes, embeddings = item
+                update_batch(
+                    cur, table, pk_cols, embeddings, pk_values, hashes, column, derived
+                )
+                # batches finish out of order with several encoders, the checkpoint only moves
+                # past a batch once every batch before it is written too
+                written[seq] = last_key
+                checkpoint = None
+                while next_seq in written:
+                    checkpoint = written.pop(next_seq)
+                    next_seq += 1
+                if checkpoint is not None:
+                    save_checkpoint(cur, checkpoint_key, checkpoint)
+                connection.commit()
+                updated += len(pk_values)
+                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                print(
+                    f"[{now}] Updated {len(pk_values)} rows in `{table}.{column}`"
+                    + "." * randint(1, 20)
+                )
+    finally:
+        for encoder in encoders:
+            if encoder.is_alive():
+                encoder.terminate()
+    reader.join()
+    if errors:
+        raise errors[0]
+    # a complete pass, the next run starts from the beginning
+    with connection.cursor() as cur:
+        save_checkpoint(cur, checkpoint_key, None)
+    connection.commit()
+    if derived and updated:
+        print(
+            f"The coarse embeddings of the {updated} updated rows of `{table}` were cleared,"
+            " run db/create_coarse_embeddings.py to compute them again"
+        )
+
+
+# `embedding` itself, not embedding_next or embedding_coarse
+EMBEDDING_COLUMN = re.compile(r"\bembedding\b")
+
+
+def embedding_indexes(cursor, table: str) -> dict[str, str]:
+    """
+    Name -> definition of the indexes of `table` on `embedding` or an expression of it (HNSW, halfvec, binary,
+    partial indexes on `embedding IS NOT NULL`), except the backfill's own pending index
+    """
+    cursor.execute(
+        "SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s",
+        (table.lower(),),
+    )
+    return {
+        name: definition
+        for name, definition in cursor.fetchall()
+        if EMBEDDING_COLUMN.search(definition) and "_pending_" not in name
+    }
+
+
+def vector_dim(cursor, table: str, column: str) -> int:
+    # the type modifier of a vector column is its number of dimensions
+    cursor.execute(
+        "SELECT atttypmod FROM pg_attribute WHERE attrelid = %s::regclass AND attname = %s",
+        (table.lower(), column),
+    )
+    return cursor.fetchone()[0]
+
+
+def index_validity(cursor, table: str) -> dict[str, bool]:
+    """
+    Name -> whether it is usable, for every index of `table`. A CREATE INDEX CONCURRENTLY that failed
+    or was interrupted leaves an INVALID index behind, which the planner never uses
+    """
+    cursor.execute(
+        """
+        SELECT c.relname, i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass
+        """,
+        (table.lower(),),
+    )
+    return dict(cursor.fetchall())
+
+
+def create_shadow_indexes(connection: psycopg2.extensions.connection, tables: list[str]):
+    """
+    Builds a copy of every index on `embedding` over `embedding_next`, named `<index>_next` (concurrently,
+    so the server keeps running), for `swap_shadow` to put in place of the old ones
+    """
+    connection.autocommit = True
+    with connection.cursor() as cur:
+        cur.execute("SET maintenance_work_mem = %s;", (os.getenv("RAM_LIMIT", "8GB"),))
+        for table in tables:
+            old_dim = vector_dim(cur, table, "embedding")
+            new_dim = vector_dim(cur, table, "embedding_next")
+            validity = index_validity(cur, table)
+            for name, definition in embedding_indexes(cur, table).items():
+                if validity.get(f"{name}_next") is False:
+                    # left by an interrupted build, IF NOT EXISTS would keep it as is
+                    print(f"Dropping the invalid index {name}_next")
+                    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_next;")
+                definition = re.sub(
+                    r"^CREATE (UNIQUE )?INDEX \S+ ON",
+                    lambda match: f"CREATE {match.group(1) or ''}INDEX CONCURRENTLY IF NOT EXISTS {name}_next ON",
+                    definition,
+                )
+                definition = EMBEDDING_COLUMN.sub("embedding_next", definition)
+                # quantized expressions are cast to the number of dimensions
+                definition = re.sub(
+                    rf"::(halfvec|bit|vector)\({old_dim}\)", rf"::\1({new_dim})", definition
+                )
+                print("Running query:\n", definition)
+                cur.execute(definition)
+            cur.execute(f"ANALYZE {table};")
+    connection.autocommit = False
+
+
+def swap_shadow(connection: psycopg2.extensions.connection, tables: list[str]):
+    """
+    Replaces `embedding` with the fully computed shadow column `embedding_next` (and their metadata) in `tables`,
+    in one transaction, so queries see either every old embedding or every new one.
+    Every index of the old column must have its copy on the new one (`create_shadow_indexes`), the copies take
+    their names, so searches stay indexed through the swap. The coarse embeddings, derived from the old ones,
+    are dropped (db/create_coarse_embeddings.py computes them again)
+    """
+    with connection.cursor() as cur:
+        renames: dict[str, list[str]] = {}
+        for table in tables:
+            cur.execute(f"SELECT COUNT(*) FROM {table} WHERE embedding_next IS NULL")
+            missing = cur.fetchone()[0]
+            if missing:
+                raise RuntimeError(
+                    f"`{table}` has {missing} rows without embedding_next, finish the shadow backfill first"
+                )
+            renames[table] = list(embedding_indexes(cur, table))
+            validity = index_validity(cur, table)
+            # missing or INVALID copies, the searches would fall back to sequential scans after the swap
+            unbuilt = [name for name in renames[table] if not validity.get(f"{name}_next")]
+            if unbuilt:
+                raise RuntimeError(
+                    f"`{table}` has no valid copy on embedding_next of the indexes {', '.join(unbuilt)},"
+                    " build them first with --shadow-indexes"
+                )
+        for table in tables:
+            cur.execute(
+                f"""
+                ALTER TABLE {table}
+                DROP COLUMN embedding,
+                DROP COLUMN IF EXISTS embedding_model,
+                DROP COLUMN IF EXISTS embedding_text_hash,
+                DROP COLUMN IF EXISTS embedding_coarse
+                """
             )
+            for suffix in ("", "_model", "_text_hash"):
+                cur.execute(
+                    f"ALTER TABLE {table} RENAME COLUMN embedding_next{suffix} TO embedding{suffix}"
+                )
+            for name in renames[table]:
+                cur.execute(f"ALTER INDEX {name}_next RENAME TO {name}")
+            cur.execute(
+                f"ALTER INDEX IF EXISTS {table.lower()}_pending_embedding_next_idx"
+                f" RENAME TO {table.lower()}_pending_embedding_idx"
+            )
+            print(f"Swapped the embeddings of `{table}` and their {len(renames[table])} indexes")
+    connection.commit()
 
 
 def show_progress(conn: psycopg2.extensions.connection):
@@ -158,20 +762,88 @@ def show_progress(conn: psycopg2.extensions.connection):
 
 
 def main():
-    conn = psycopg2.connect(
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=1, help="encoder processes, each loads the model"
     )
-    register_vector(conn)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="torch threads per encoder process (default: cores / workers)",
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the checkpoint of an interrupted run and scan from the first row",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="also re-embed rows whose text or model changed since they were embedded",
+    )
+    parser.add_argument(
+        "--stamp",
+        action="store_true",
+        help="with --incremental, take embeddings without metadata as current and only record it",
+    )
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="write to embedding_next, leaving the served embedding column untouched until --swap",
+    )
+    parser.add_argument(
+        "--shadow-indexes",
+        action="store_true",
+        help="build copies of the indexes of embedding on embedding_next (needed by --swap), then exit",
+    )
+    parser.add_argument(
+        "--swap",
+        action="store_true",
+        help="replace embedding with the completed embedding_next, then exit",
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=0, help="batches buffered between stages (default: 2 per worker)"
+    )
+    args = parser.parse_args()
+    if args.stamp and not args.incremental:
+        parser.error("--stamp only applies to --incremental runs")
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    options = dict(
+        workers=args.workers,
+        threads=threads,
+        batch_size=args.batch_size,
+        queue_size=args.queue_size or 2 * args.workers,
+        resume=not args.restart,
+        column="embedding_next" if args.shadow else "embedding",
+        incremental=args.incremental,
+        stamp=args.stamp,
+    )
+
+    conn = connect()
+    if args.shadow_indexes:
+        create_shadow_indexes(conn, ["Sentence", "Related_text"])
+        conn.close()
+        return
+    if args.swap:
+        if (
+            input(
+                "This will replace the embeddings with embedding_next and drop the coarse embeddings. Are you sure? (y/n): "
+            ).lower()
+            != "y"
+        ):
+            print("Not Confirmed...")
+        else:
+            swap_shadow(conn, ["Sentence", "Related_text"])
+        conn.close()
+        return
     # show_progress(conn)
-    Transformer.load(model_name)
+    print(f"Embedding with {args.workers} encoder process(es) of {threads} thread(s)")
 
     try:
-        process_table(conn, "Sentence", ["sentence_id", "section_id"], "text")
-        process_table(conn, "Related_text", ["related_id"], "details")
+        process_table(conn, "Sentence", ["sentence_id", "section_id"], "text", **options)
+        process_table(conn, "Related_text", ["related_id"], "details", **options)
     except KeyboardInterrupt:
         print("Keyboard Interrupt. Exiting...")
     except Exception as e:
@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Sequence
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-item calls into batches.
+    The first queued item waits at most `max_wait` seconds for others to join it, then `fn` runs once
+    on up to `max_batch_size` items. `fn` maps a list of inputs to a sequence of outputs of the same length.
+    Items of a single `submit_many` call are queued together, so they share batches as well
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list], Sequence],
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        name: str = "micro-batcher",
+    ):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, item) -> Future:
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items: list) -> list[Future]:
+        self._start()
+        futures: list[Future] = []
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        return futures
+
+    def __call__(self, items: list) -> list:
+        return [future.result() for future in self.submit_many(items)]
+
+    def close(self):
+        self._queue.put(None)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    # keep draining what is already queued even after the deadline
+                    entry = (
+                        self._queue.get(timeout=remaining)
+                        if remaining > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._process(batch)
+
+    def _process(self, batch: list[tuple]):
+        futures = [future for _, future in batch]
+        try:
+            outputs = self.fn([item for item, _ in batch])
+            if len(outputs) != len(batch):
+                raise ValueError(
+                    f"{self.name}: got {len(outputs)} outputs for a batch of {len(batch)} items"
+                )
+            for future, output in zip(futures, outputs):
+                # a caller may have cancelled its future meanwhile
+                if not future.done():
+                    future.set_result(output)
+        except Exception as e:
+            # every caller of the batch gets the error, none is left waiting
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
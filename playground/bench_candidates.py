@@ -0,0 +1,117 @@
+"""
+Evaluates a two-stage candidate search (approximate first stage, then full-embedding rerank) against
+the full-precision HNSW search, on the queries of `test/test_data.json`. The first stage (`--mode`) is either:
+
+- coarse: the Matryoshka prefix, needs `python -m db.create_coarse_embeddings` run with the same COARSE_DIM
+- halfvec / binary: the quantized embedding, needs `python db/create_quantized_indexes.py --kind <mode>`
+
+It reports the recall (share of the full search's `--count` candidates per source that the two-stage search
+also returns), the latency of the candidate query of each mode (over queries and sources), and the total size
+of the full and first stage HNSW indexes. With `--end-to-end` it also runs the whole retrieval in both modes
+and compares the recall of the expected verses of the evaluation set in the returned sentences.
+
+    python -m playground.bench_candidates --mode coarse --dim 256 --oversample 4 --count 20
+    python -m playground.bench_candidates --mode binary --oversample 10
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+from playground.test import RetrieverBySource, embed_many
+
+INDEX_PATTERNS = {
+    "full": "related_text_embed_hnsw%",
+    "coarse": "related_text_coarse_hnsw%",
+    "halfvec": "related_text_halfvec_hnsw%",
+    "binary": "related_text_binary_hnsw%",
+}
+INDEX_SIZE_SQL = """
+    SELECT COALESCE(SUM(pg_relation_size(indexrelid)), 0)
+    FROM pg_index
+    JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+    WHERE pg_class.relname LIKE %s
+"""
+
+
+def candidates(
+    retriever: RetrieverBySource, source_id: str, embedding: np.ndarray, count: int
+) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    rows = retriever.run_query(
+        retriever.source_candidates(source_id),
+        retriever.query_params(embedding, count),
+        prepare=True,
+        before=retriever.search_settings(count),
+    )
+    return [related_id for related_id, _ in rows], time.perf_counter() - start
+
+
+def verse_recall(
+    retriever: RetrieverBySource,
+    test_data: dict[str, list[list[int]]],
+    source_ids: list[str],
+    count: int,
+) -> float:
+    found = total = 0
+    for query, verses in test_data.items():
+        result = retriever.search(query, source_ids, count)
+        returned = {(s.section_id, s.sentence_id) for s in result.sentences}
+        # the evaluation set lists verses as [sura, aya], that is [section_id, sentence_id]
+        found += sum(1 for sura, aya in verses if (sura, aya) in returned)
+        total += len(verses)
+    return found / total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default="test/test_data.json")
+    parser.add_argument("--mode", choices=["coarse", "halfvec", "binary"], default="coarse")
+    parser.add_argument("--dim", type=int, default=int(os.getenv("COARSE_DIM", 256)))
+    parser.add_argument("--oversample", type=int, default=4)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--sources", default=None, help="comma separated source ids, all by default")
+    parser.add_argument("--end-to-end", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.path, "r", encoding="utf-8") as f:
+        test_data: dict[str, list[list[int]]] = json.load(f)
+    queries = list(test_data)
+    full = RetrieverBySource()
+    # its own connection, so its search settings never apply to the baseline
+    two_stage = RetrieverBySource(
+        coarse_dim=args.dim if args.mode == "coarse" else None,
+        quantization=args.mode if args.mode != "coarse" else None,
+        oversample=args.oversample,
+    )
+    source_ids = args.sources.split(",") if args.sources else full.source_ids
+    embeddings = embed_many(queries)
+
+    recalls: list[float] = []
+    timings: dict[str, list[float]] = {"full": [], args.mode: []}
+    for embedding in embeddings:
+        for source_id in source_ids:
+            expected, elapsed = candidates(full, source_id, embedding, args.count)
+            timings["full"].append(elapsed)
+            found, elapsed = candidates(two_stage, source_id, embedding, args.count)
+            timings[args.mode].append(elapsed)
+            if expected:
+                recalls.append(len(set(found) & set(expected)) / len(expected))
+
+    print(
+        f"{len(queries)} queries x {len(source_ids)} sources, {args.count} candidates, "
+        f"{args.mode} first stage{f' (dim {args.dim})' if args.mode == 'coarse' else ''}, oversample {args.oversample}"
+    )
+    print(f"recall of the full search: mean {np.mean(recalls):.3f}, min {np.min(recalls):.3f}")
+    for mode, values in timings.items():
+        print(f"{mode:>7} candidates: median {np.median(values) * 1000:.1f} ms, p95 {np.percentile(values, 95) * 1000:.1f} ms")
+    for mode in timings:
+        size = full.run_query(INDEX_SIZE_SQL, (INDEX_PATTERNS[mode],))[0][0]
+        print(f"{mode:>7} HNSW indexes: {size / 2**20:.0f} MiB")
+    if args.end_to_end:
+        for mode, retriever in [("full", full), (args.mode, two_stage)]:
+            print(f"{mode:>7} verse recall: {verse_recall(retriever, test_data, source_ids, args.count):.3f}")
+
+
+if __name__ == "__main__":
+    main()
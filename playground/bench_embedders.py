@@ -0,0 +1,130 @@
+"""
+Compares the embedding backends of `playground/embedders.py` against the reference `torch` backend
+on the queries of `test/test_data.json` (query -> [[sura, aya], ...] of the verses that answer it):
+
+- latency of encoding one query (p50/p95) and of the whole query set as one batch
+- agreement with the stored embeddings: cosine between each backend's embedding of a sample of verses
+  and the stored (torch) embedding of the same verses
+- agreement with `torch` on the queries, and recall@k of the expected verses in the top-k verses
+
+A backend is within tolerance when both its query and verse cosines stay above `--min-cosine` (on every text)
+and its recall@k is at most `--max-recall-drop` below the reference.
+Needs the database (or a verse cache at `--verses`) for the stored embeddings.
+
+    python -m playground.bench_embedders --backends torch,onnx,onnx-int8,torch-int8 --k 10
+"""
+import argparse
+import json
+import time
+import numpy as np
+from playground.embedders import BACKENDS, load_embedder
+from playground.test import RelatedTextRetriever, cleaner, model
+from playground.verses import VerseMatrix
+
+
+def encode(embedder, texts: list[str]) -> np.ndarray:
+    return np.asarray(
+        embedder.encode(texts, normalize_embeddings=True, batch_size=len(texts)),
+        dtype=np.float32,
+    )
+
+
+def latencies(embedder, queries: list[str], repeat: int) -> tuple[float, float, float]:
+    single: list[float] = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            encode(embedder, [query])
+            single.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        encode(embedder, queries)
+    batch = (time.perf_counter() - start) / repeat
+    return float(np.percentile(single, 50)), float(np.percentile(single, 95)), batch
+
+
+def recall_at_k(
+    verses: VerseMatrix, embeddings: np.ndarray, expected: list[set], k: int
+) -> tuple[float, list[set]]:
+    found = 0
+    top_sets: list[set] = []
+    for vec, verse_keys in zip(embeddings, expected):
+        top = {(sentence_id, section_id) for sentence_id, section_id, *_ in verses.top_k(vec, k)}
+        top_sets.append(top)
+        found += len(top & verse_keys)
+    return found / sum(len(keys) for keys in expected), top_sets
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default="test/test_data.json")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--sample", type=int, default=500, help="verses encoded to compare with the stored embeddings")
+    parser.add_argument("--verses", default="cache/verses", help="verse embeddings cache, see VerseMatrix.load")
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--max-recall-drop", type=float, default=0.02)
+    args = parser.parse_args()
+
+    with open(args.path, "r", encoding="utf-8") as f:
+        test_data: dict[str, list[list[int]]] = json.load(f)
+    queries = [cleaner.cleanText(query) for query in test_data]
+    # the verse index is keyed by (sentence_id, section_id), that is (aya, sura)
+    expected = [{(aya, sura) for sura, aya in verses} for verses in test_data.values()]
+
+    verses = VerseMatrix.load(RelatedTextRetriever().run_query, args.verses, model)
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(verses), size=min(args.sample, len(verses)), replace=False)
+    sample_texts = [cleaner.cleanText(verses.texts[row]) for row in sample]
+    stored = np.asarray(verses.matrix[sample], dtype=np.float32)
+
+    backends = args.backends.split(",")
+    if "torch" in backends:
+        # the reference goes first, the others are compared to it
+        backends = ["torch"] + [backend for backend in backends if backend != "torch"]
+    reference: dict[str, object] = {}
+    print(f"{len(queries)} queries, {len(sample_texts)} sampled verses, recall@{args.k}")
+    for backend in backends:
+        start = time.perf_counter()
+        embedder = load_embedder(model, backend)
+        load_time = time.perf_counter() - start
+        encode(embedder, queries[:1])
+
+        p50, p95, batch = latencies(embedder, queries, args.repeat)
+        query_embeddings = encode(embedder, queries)
+        verse_cosines = np.sum(encode(embedder, sample_texts) * stored, axis=1)
+        recall, top_sets = recall_at_k(verses, query_embeddings, expected, args.k)
+
+        print(f"\n{backend}: loaded in {load_time:.1f}s")
+        print(f"  latency per query: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms")
+        print(f"  batch of {len(queries)}: {batch * 1000:.1f} ms")
+        print(
+            f"  cosine to stored verse embeddings: mean {verse_cosines.mean():.4f}, min {verse_cosines.min():.4f}"
+        )
+        print(f"  recall@{args.k}: {recall:.3f}")
+        if not reference:
+            reference = {
+                "name": backend,
+                "embeddings": query_embeddings,
+                "recall": recall,
+                "top": top_sets,
+            }
+            continue
+        query_cosines = np.sum(query_embeddings * reference["embeddings"], axis=1)
+        overlap = np.mean(
+            [len(top & ref) / args.k for top, ref in zip(top_sets, reference["top"])]
+        )
+        print(
+            f"  cosine to {reference['name']} query embeddings: mean {query_cosines.mean():.4f}, min {query_cosines.min():.4f}"
+        )
+        print(f"  top-{args.k} overlap with {reference['name']}: {overlap:.3f}")
+        within = (
+            min(query_cosines.min(), verse_cosines.min()) >= args.min_cosine
+            and reference["recall"] - recall <= args.max_recall_drop
+        )
+        print(f"  {'within' if within else 'OUT OF'} tolerance")
+
+
+if __name__ == "__main__":
+    main()
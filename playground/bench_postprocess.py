@@ -0,0 +1,314 @@
+"""
+Micro-benchmark of the retrieval post-processing (`related_texts_to_sentences` -> scoring -> `merge_sentences`
+-> `filter_results` -> `finalize`) against the previous list-based implementation.
+
+Candidate sets are rebuilt from the recorded results in `raw_results.json`, then every related text is
+replicated over `--sources` sources and `--count` chunks per source, like a real all-sources query.
+Both implementations score the verses against the recorded query with the embedding model, so an untimed
+pass fills the embedding cache first and the timings only cover the post-processing.
+
+    python -m playground.bench_postprocess --sources 60 --count 20 --repeat 5
+"""
+import argparse
+import json
+import time
+from playground.test import (
+    RetrieverBySource,
+    RelatedText,
+    Result,
+    Sentence,
+    SentenceRelatedTexts,
+    SentenceWithRelations,
+    Source,
+    get_similarity,
+    merge_details,
+)
+
+
+class LegacyPostProcessing(RetrieverBySource):
+    """
+    The post-processing as it was before it moved to keyed dictionaries and vectorized scoring, kept as a reference:
+    every method `retrieve` runs after fetching the candidates is the original one
+    """
+
+    def finalize(self, results: list[SentenceRelatedTexts]) -> Result:
+        """
+        Finalizes the results by returning each sentence and related text alone once
+        """
+        unique_sentences: dict[tuple[int, int], Sentence] = {}
+        unique_related_texts: dict[str, RelatedText] = {}
+        related_texts_per_sentence: dict[tuple[int, int], list[str]] = {}
+        for result in results:
+            sentence = result.sentence
+            sentence.similarity = result.final_score
+            key = (sentence.sentence_id, sentence.section_id)
+            unique_sentences[key] = sentence
+            if key not in related_texts_per_sentence:
+                related_texts_per_sentence[key] = []
+            related_texts = result.related_texts
+            for rt in related_texts:
+                related_texts_per_sentence[key].append(rt.related_text_id)
+                unique_related_texts[rt.related_text_id] = rt
+        sentences_with_relations: list[SentenceWithRelations] = []
+        for key, sentence in unique_sentences.items():
+            related_texts = related_texts_per_sentence[key]
+            related_texts.sort()
+            sentences_with_relations.append(
+                SentenceWithRelations(
+                    sentence_id=sentence.sentence_id,
+                    section_id=sentence.section_id,
+                    text=sentence.text,
+                    similarity=sentence.similarity,
+                    related_text_ids=related_texts,
+                )
+            )
+        # sort sentences by section id then sentence id
+        sentences_with_relations.sort(key=lambda x: (x.section_id, x.sentence_id))
+        all_related_texts: set[str] = set()
+        # sort related texts by order they appear in for the sentences
+        for sentence in sentences_with_relations:
+            for related_text_id in sentence.related_text_ids:
+                all_related_texts.add(related_text_id)
+        related_texts = [unique_related_texts[rt_id] for rt_id in all_related_texts]
+        result = Result(sentences=sentences_with_relations, related_texts=related_texts)
+        return result
+
+    def related_texts_to_sentences(
+        self, related_texts: list[RelatedText]
+    ) -> list[SentenceRelatedTexts]:
+        """
+        Transforms the returned values from RT: list[S] to S: list[RT]
+        It also calculates the score for the sentence based on its related text
+        """
+        sentence_related_texts: list[SentenceRelatedTexts] = list()
+        for rt in related_texts:
+            for sentence in rt.related_sentences:
+                if sentence in sentence_related_texts:
+                    idx = sentence_related_texts.index(sentence)
+                    sentence_related_texts[idx].related_texts.append(rt)
+                    sentence_related_texts[idx].score.append(rt.similarity)
+                else:
+                    sentence_related_texts.append(
+                        SentenceRelatedTexts(
+                            sentence=sentence, related_texts=[rt], score=[rt.similarity]
+                        )
+                    )
+        return sentence_related_texts
+
+    def score_sentence(self, sentence_related_text: SentenceRelatedTexts) -> float:
+        """
+        this should do the following:
+        1. for each related text, if it has the same prefix excluding the ending after _ (xxx_x)
+        we add a significant part of its score, else we add a small asymptotic part of its score
+        2. we sort the related_texts by score value and get a final score from them (currently adds them as a power series)
+        """
+        related_text_id_counts: dict[str, list[float]] = {}
+        for related_text in sentence_related_text.related_texts:
+            prefix = related_text.related_text_id.rsplit("_", 1)[0]
+            if prefix not in related_text_id_counts:
+                related_text_id_counts[prefix] = [related_text.similarity]
+            else:
+                related_text_id_counts[prefix].append(related_text.similarity)
+        # now for each one, compute a similarity score using a power series
+        related_text_id_scores: dict[str, float] = {}
+        for prefix, similarities in related_text_id_counts.items():
+            related_text_id_scores[prefix] = self.get_score(similarities)
+
+        related_text_id_scores = dict(
+            sorted(
+                related_text_id_scores.items(), key=lambda item: item[1], reverse=True
+            )
+        )
+
+        score = self.get_score(related_text_id_scores.values())
+        return score
+
+    def merge_sentences(
+        self,
+        sentence_related_texts: list[SentenceRelatedTexts],
+        user_query: str,
+    ) -> list[SentenceRelatedTexts]:
+        """
+        Merges the sentences' related texts from all the different sources
+        Also re-calculates the final scores for each sentence
+        """
+        merged: dict[str, SentenceRelatedTexts] = {}
+        for sentence_related_text in sentence_related_texts:
+            sentence = sentence_related_text.sentence
+            key = f"{sentence.sentence_id}_{sentence.section_id}"
+            if key not in merged:
+                merged[key] = sentence_related_text
+            else:
+                merged[key].related_texts.extend(sentence_related_text.related_texts)
+                merged[key].score.extend(sentence_related_text.score)
+        # here, each object has the score a list of scores across different sources
+        sentences = sorted(merged.values(), key=lambda x: max(x.score), reverse=True)
+        for sentence in sentences:
+            sentence.final_score = self.get_score(sentence.score)
+            sentence.final_score = self.balance_threshold * sentence.final_score + (
+                1 - self.balance_threshold
+            ) * get_similarity(sentence.sentence.text, user_query)
+        # now each sentence has its final score
+        return sentences
+
+    def filter_results(
+        self,
+        results: list[SentenceRelatedTexts],
+    ) -> list[SentenceRelatedTexts]:
+        # for significant related_texts that have same content without the $$ signed, we need to merge them, preserving the $$ signs, and mix their scores
+        for sentence in results:
+            rt_by_prefix: dict[str, list[RelatedText]] = {}
+            for rt in sentence.related_texts:
+                prefix = rt.related_text_id.rsplit("_", 1)[0]
+                if prefix not in rt_by_prefix:
+                    rt_by_prefix[prefix] = [rt]
+                else:
+                    rt_by_prefix[prefix].append(rt)
+            merged_rts: list[RelatedText] = []
+            for prefix, rts in rt_by_prefix.items():
+                # sort by position of the first $$
+                rts.sort(key=lambda x: x.related_text_id.find("$$"))
+                strings = [rt.details for rt in rts]
+                rt = RelatedText(
+                    related_text_id=prefix,
+                    related_sentences=rts[0].related_sentences,
+                    source=rts[0].source,
+                    details=merge_details(strings),
+                    similarity=self.get_score([rt.similarity for rt in rts]),
+                )
+                merged_rts.append(rt)
+            sentence.related_texts = merged_rts
+
+        filtered_results: list[SentenceRelatedTexts] = []
+        # we need to delete sentences that have a final score below the threshold
+        for sentence in results:
+            if sentence.final_score >= self.sentence_threshold:
+                filtered_results.append(sentence)
+        # now for the remaining sentences, filter the related texts with a low contribution
+        for sentence in filtered_results:
+            sentence.related_texts = [
+                rt
+                for rt in sentence.related_texts
+                if rt.similarity >= self.rt_threshold
+            ]
+
+        return filtered_results
+
+
+def make_processor(cls: type[RetrieverBySource]) -> RetrieverBySource:
+    # the post-processing only needs the scoring settings, not a connection
+    processor = cls.__new__(cls)
+    processor.base = 0.3
+    processor.sentence_threshold = 0.5
+    processor.rt_threshold = 0.4
+    processor.balance_threshold = 0.9
+    processor.verses = None
+    return processor
+
+
+def candidate_sets(
+    path: str, sources: int, count: int
+) -> list[tuple[str, dict[str, list[RelatedText]]]]:
+    """
+    Rebuilds per-source candidate lists of each recorded query from recorded results: each recorded related text
+    (with the sentences that referenced it) is cloned as chunk `part` of source `src`
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        recorded = json.load(f)
+    sets: list[tuple[str, dict[str, list[RelatedText]]]] = []
+    for query, result in recorded.items():
+        if not result["related_texts"]:
+            continue
+        sentences_by_rt: dict[str, list[dict]] = {}
+        for sentence in result["sentences"]:
+            for rt_id in sentence["related_text_ids"]:
+                sentences_by_rt.setdefault(rt_id, []).append(sentence)
+        by_source: dict[str, list[RelatedText]] = {}
+        for src in range(sources):
+            source_id = f"1_{src}"
+            source = Source(source_id, "", "", "", "", "")
+            candidates: list[RelatedText] = []
+            for part in range(count):
+                recorded_rt = result["related_texts"][part % len(result["related_texts"])]
+                details = recorded_rt["details"]
+                candidates.append(
+                    RelatedText(
+                        related_text_id=f"{source_id}_{recorded_rt['related_text_id']}_{part // 4}_{part % 4}",
+                        related_sentences=[
+                            Sentence(
+                                sentence_id=s["sentence_id"],
+                                section_id=s["section_id"],
+                                text=s["text"],
+                                # the recorded similarity is the final score, not the query similarity:
+                                # unknown, so both implementations get it from the model
+                                similarity=-1,
+                            )
+                            for s in sentences_by_rt.get(
+                                recorded_rt["related_text_id"], []
+                            )
+                        ],
+                        source=source,
+                        details=f"{details[:20]}$${details[20:]}$$",
+                        similarity=recorded_rt["similarity"],
+                    )
+                )
+            by_source[source_id] = candidates
+        sets.append((query, by_source))
+    return sets
+
+
+def run(
+    processor: RetrieverBySource, query: str, by_source: dict[str, list[RelatedText]]
+):
+    results: list[SentenceRelatedTexts] = []
+    for related_texts in by_source.values():
+        result = processor.related_texts_to_sentences(related_texts)
+        for sentence in result:
+            sentence.score = [processor.score_sentence(sentence)]
+        results.extend(result)
+    results = processor.merge_sentences(results, query)
+    results = processor.filter_results(results)
+    return processor.finalize(results)
+
+
+def normalized(result) -> dict:
+    result = result.to_dict()
+    result["related_texts"].sort(key=lambda rt: rt["related_text_id"])
+    # float32 matrix products and float64 dot products differ in the last digits
+    for item in result["sentences"] + result["related_texts"]:
+        item["similarity"] = round(item["similarity"], 5)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", default="raw_results.json")
+    parser.add_argument("--sources", type=int, default=60)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    timings: dict[str, float] = {}
+    outputs: dict[str, list[dict]] = {}
+    for name, cls in [("legacy", LegacyPostProcessing), ("current", RetrieverBySource)]:
+        processor = make_processor(cls)
+        for query, by_source in candidate_sets(args.path, args.sources, args.count):
+            run(processor, query, by_source)
+        elapsed = 0.0
+        for _ in range(args.repeat):
+            # the pipeline mutates its input, so every run gets fresh candidates
+            sets = candidate_sets(args.path, args.sources, args.count)
+            start = time.perf_counter()
+            outputs[name] = [
+                normalized(run(processor, query, by_source)) for query, by_source in sets
+            ]
+            elapsed += time.perf_counter() - start
+        timings[name] = elapsed / args.repeat
+        print(f"{name:>8}: {timings[name] * 1000:.1f} ms for {len(sets)} queries")
+
+    print(f" speedup: {timings['legacy'] / timings['current']:.1f}x")
+    print("same results:", outputs["legacy"] == outputs["current"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+import abc
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from cachetools import TTLCache
+
+
+def cache_key(*parts) -> str:
+    """
+    Stable key for any JSON-serializable parts (the same across processes and restarts)
+    """
+    return hashlib.sha256(
+        json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """
+    Connection to a SQLite file shared by several processes (created with its directory if missing),
+    usable from any thread as long as the caller serializes access
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    with conn:
+        # WAL lets readers in other processes go on while one of them writes
+        conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+class Cache(abc.ABC):
+    """
+    Key/value cache with a time to live and a size limit.
+    Backends implement `_get` and `_set`, hits and misses are counted here
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        self._set(key, value)
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    @abc.abstractmethod
+    def _get(self, key: str):
+        """The value of `key`, None if it is missing or expired"""
+
+    @abc.abstractmethod
+    def _set(self, key: str, value):
+        """Stores `value` under `key` for `ttl` seconds"""
+
+
+class MemoryCache(Cache):
+    """In-process LRU with TTL, values are kept as is (no copy, no serialization)"""
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 10_000):
+        super().__init__(ttl, max_entries)
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def _get(self, key: str):
+        with self._lock:
+            return self._entries.get(key)
+
+    def _set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = value
+
+
+class SQLiteCache(Cache):
+    """
+    On-disk cache in a SQLite file, shared by every process (server workers) using the same path.
+    Entries expire after `ttl` seconds and the least recently used ones are evicted past `max_entries`.
+    Expired and excess entries are removed every `evict_every` writes (of this process), not on each one
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 3600,
+        max_entries: int = 100_000,
+        evict_every: int = 100,
+    ):
+        super().__init__(ttl, max_entries)
+        self.evict_every = evict_every
+        self._writes = 0
+        self._conn = connect_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)"
+            )
+
+    def _get(self, key: str):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return pickle.loads(row[0])
+
+    def _set(self, key: str, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, pickle.dumps(value), now + self.ttl, now),
+            )
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        # both deletes walk an index, the second one only the entries past the limit
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        excess = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY accessed_at LIMIT ?
+                )
+                """,
+                (excess,),
+            )
+
+
+class RedisCache(Cache):
+    """
+    Cache on a Redis (or Redis-compatible) server, shared by every process and machine using it.
+    Expiry is left to Redis, so the size limit is Redis' own `maxmemory` policy
+    """
+
+    def __init__(self, url: str, ttl: float = 3600, prefix: str = "fyp:"):
+        import redis
+
+        super().__init__(ttl, 0)
+        self._redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _get(self, key: str):
+        value = self._redis.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def _set(self, key: str, value):
+        self._redis.set(self.prefix + key, pickle.dumps(value), ex=int(self.ttl))
+
+
+def make_cache(
+    backend: str, ttl: float, max_entries: int, location: str = None
+) -> Cache | None:
+    """
+    backend is one of "memory", "sqlite" (location is the file path) or "redis" (location is the URL),
+    anything else disables caching
+    """
+    if backend in ("sqlite", "redis") and not location:
+        raise ValueError(f"The {backend} cache needs a location (a file path or a URL)")
+    if backend == "memory":
+        return MemoryCache(ttl, max_entries)
+    if backend == "sqlite":
+        return SQLiteCache(location, ttl, max_entries)
+    if backend == "redis":
+        return RedisCache(location, ttl)
+    return None
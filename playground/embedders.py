@@ -0,0 +1,88 @@
+"""
+Embedding backends for query encoding. Every backend is loaded as a SentenceTransformer, so they all share
+its `encode(texts, normalize_embeddings=..., batch_size=...)` interface and only differ in how inference runs:
+
+    torch        the reference, the one the stored embeddings were computed with (db/update_tables.py)
+    torch-int8   torch with its Linear layers dynamically quantized to int8 (CPU only)
+    onnx         ONNX Runtime, fp32 (needs `pip install sentence-transformers[onnx]`)
+    onnx-int8    ONNX Runtime with int8 dynamically quantized weights (same extra)
+
+The ONNX exports are written once under `EMBEDDING_ONNX_DIR` and reused by later processes.
+`playground/bench_embedders.py` measures the latency and the agreement of each backend with `torch`
+"""
+import os
+import numpy as np
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def _onnx_dir(model: str) -> str:
+    return os.path.join(
+        os.environ.get("EMBEDDING_ONNX_DIR", "cache/onnx"), model.replace("/", "__")
+    )
+
+
+def _load_onnx(model: str, quantized: bool):
+    from sentence_transformers import SentenceTransformer
+
+    path = _onnx_dir(model)
+    if not os.path.exists(os.path.join(path, "onnx", "model.onnx")):
+        # exports the model to ONNX, which takes a while, so it is only done the first time
+        SentenceTransformer(model, backend="onnx", device="cpu").save_pretrained(path)
+    if not quantized:
+        return SentenceTransformer(path, backend="onnx", device="cpu")
+
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    # avx512_vnni, avx512, avx2 or arm64, whichever the server's CPU supports
+    config = os.environ.get("EMBEDDING_ONNX_QUANTIZATION", "avx2")
+    file_name = f"onnx/model_qint8_{config}.onnx"
+    if not os.path.exists(os.path.join(path, file_name)):
+        export_dynamic_quantized_onnx_model(
+            SentenceTransformer(path, backend="onnx", device="cpu"), config, path
+        )
+    return SentenceTransformer(
+        path, backend="onnx", device="cpu", model_kwargs={"file_name": file_name}
+    )
+
+
+def load_embedder(model: str, backend: str = "torch"):
+    """
+    Loads `model` on the given backend (one of `BACKENDS`)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown embedding backend {backend!r}, expected one of {', '.join(BACKENDS)}"
+        )
+    if backend == "onnx":
+        return _load_onnx(model, quantized=False)
+    if backend == "onnx-int8":
+        return _load_onnx(model, quantized=True)
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch-int8":
+        # dynamic quantization only runs on CPU
+        transformer = SentenceTransformer(model, device="cpu")
+        return torch.quantization.quantize_dynamic(
+            transformer, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return SentenceTransformer(model, device=device)
+
+
+def embedder_id(model: str, backend: str = "torch") -> str:
+    """
+    Identifies the embeddings of a model/backend pair, e.g. in the on-disk embedding cache.
+    `torch` keeps the bare model name, so existing caches stay valid
+    """
+    return model if backend == "torch" else f"{model}@{backend}"
+
+
+def truncate(embeddings: np.ndarray, dim: int) -> np.ndarray:
+    """
+    The first `dim` dimensions of Matryoshka embeddings (a vector or a matrix of row vectors), L2-normalized again
+    """
+    truncated = np.asarray(embeddings, dtype=np.float32)[..., :dim]
+    return truncated / np.linalg.norm(truncated, axis=-1, keepdims=True)
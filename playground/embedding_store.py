@@ -0,0 +1,64 @@
+import hashlib
+import threading
+import numpy as np
+from playground.cache import connect_sqlite
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """
+    Persistent embedding cache in a SQLite file, keyed by (model name, hash of the cleaned text).
+    Vectors are stored as raw float32 bytes (3 KB for 768 dims), and the file can be shared by every
+    server worker and by `db/update_tables.py`, so a text is only ever encoded once per model
+    """
+
+    def __init__(self, path: str, model: str):
+        self.model = model
+        self._conn = connect_sqlite(path)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embedding (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )
+                """
+            )
+
+    def get_many(self, texts: list[str]) -> dict[str, np.ndarray]:
+        """
+        Embeddings of the given (cleaned) texts that are in the store, by text
+        """
+        hashes = {text_hash(text): text for text in texts}
+        found: dict[str, np.ndarray] = {}
+        items = list(hashes)
+        # stay under SQLite's limit of bound parameters
+        for i in range(0, len(items), 500):
+            chunk = items[i : i + 500]
+            with self._lock:
+                rows = self._conn.execute(
+                    f"""
+                    SELECT text_hash, vector FROM embedding
+                    WHERE model = ? AND text_hash IN ({", ".join("?" * len(chunk))})
+                    """,
+                    (self.model, *chunk),
+                ).fetchall()
+            for hash_, vector in rows:
+                found[hashes[hash_]] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, embeddings: dict[str, np.ndarray]):
+        rows = [
+            (self.model, text_hash(text), np.asarray(vec, dtype=np.float32).tobytes())
+            for text, vec in embeddings.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embedding VALUES (?, ?, ?)", rows
+            )
@@ -0,0 +1,179 @@
+from playground.test import (
+    RetrieverBySource,
+    RelatedText,
+    connect,
+    embed,
+    execute_query,
+    execute_prepared,
+    logger,
+)
+import os
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import psycopg2.errors
+
+
+class ConnectionPool:
+    """
+    A bounded pool of connections created by `connect()`.
+    Connections are opened lazily (up to `size`) and every checkout is rolled back before
+    being handed back, so a failed query never leaves its transaction state to the next user
+    """
+
+    def __init__(
+        self,
+        size: int = None,
+        statement_timeout: int = None,
+        checkout_timeout: float = None,
+    ):
+        self.size = size or int(os.environ.get("DB_POOL_SIZE", 8))
+        # milliseconds, 0 disables the timeout
+        self.statement_timeout = (
+            statement_timeout
+            if statement_timeout is not None
+            else int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 10_000))
+        )
+        # seconds to wait for a free connection when all of them are checked out
+        self.checkout_timeout = (
+            checkout_timeout
+            if checkout_timeout is not None
+            else float(os.environ.get("DB_CHECKOUT_TIMEOUT", 30))
+        )
+        # most recently returned last, so the warm connections are reused first
+        self._idle: list[psycopg2.extensions.connection] = []
+        self._lock = threading.Condition()
+        self._opened = 0
+        self._closed = False
+
+    def _open(self) -> psycopg2.extensions.connection:
+        if self.statement_timeout:
+            return connect(options=f"-c statement_timeout={self.statement_timeout}")
+        return connect()
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        with self._lock:
+            # waits for an idle connection or for a free slot, e.g. after a broken connection was discarded
+            if not self._lock.wait_for(
+                lambda: self._closed or self._idle or self._opened < self.size,
+                self.checkout_timeout,
+            ):
+                raise TimeoutError(
+                    f"No database connection became available within {self.checkout_timeout}s"
+                )
+            if self._closed:
+                raise RuntimeError("Connection pool is closed")
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return self._open()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+                self._lock.notify()
+            raise
+
+    def putconn(self, conn: psycopg2.extensions.connection):
+        with self._lock:
+            if self._closed or conn.closed:
+                if not conn.closed:
+                    conn.close()
+                self._opened -= 1
+                # wakes up `close` as well as the waiters that may now open a connection
+                self._lock.notify_all()
+                return
+            self._idle.append(conn)
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            try:
+                # the retrieval queries are read-only, so ending the transaction is enough
+                conn.rollback()
+            except Exception as e:
+                logger.warning("Discarding broken pooled connection: %s", e)
+                conn.close()
+            self.putconn(conn)
+
+    def close(self, timeout: float = None) -> bool:
+        """
+        Stops handing out connections and drains the pool:
+        idle connections are closed right away, checked-out ones as soon as they are returned.
+        Waits up to `timeout` seconds (forever if None) and returns whether every connection got closed
+        """
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._opened -= 1
+            self._lock.notify_all()
+            return self._lock.wait_for(lambda: self._opened <= 0, timeout)
+
+
+class PooledRetrieverBySource(RetrieverBySource):
+    """
+    RetrieverBySource that checks out a pooled connection per query instead of sharing one cursor.
+    Multi-source retrieval fans `retrieve_by_source_id` out over a bounded thread pool and merges the results,
+    so it is safe to share one instance between threads (e.g. concurrent Flask requests)
+    """
+
+    def __init__(self, pool: ConnectionPool = None, **kwargs):
+        self.pool = pool or ConnectionPool(
+            size=kwargs.get("pool_size"),
+            statement_timeout=kwargs.get("statement_timeout"),
+        )
+        # fan the sources out over threads, otherwise run the single statement on one pooled connection
+        self.parallel = kwargs.get("parallel", True)
+        self.executor = ThreadPoolExecutor(
+            max_workers=kwargs.get("workers", self.pool.size),
+            thread_name_prefix="retriever",
+        )
+        super().__init__(None, **kwargs)
+
+    def run_query(
+        self, sql_query: str, params=None, prepare: bool = False, before: str = ""
+    ) -> list[tuple]:
+        # statements are prepared per connection, so each pooled connection prepares its own on first use
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                if prepare:
+                    execute_prepared(cursor, conn, sql_query, params, before)
+                else:
+                    execute_query(cursor, conn, before + sql_query, params)
+                return cursor.fetchall()
+
+    def retrieve_by_source_ids(
+        self,
+        user_query: str,
+        source_ids: list[str],
+        count: int,
+    ) -> dict[str, list[RelatedText]]:
+        if not self.parallel:
+            return super().retrieve_by_source_ids(user_query, source_ids, count)
+        # embed once up front so the worker threads all hit the cache
+        embed(user_query)
+        futures = {
+            source_id: self.executor.submit(
+                self.retrieve_by_source_id, user_query, source_id, count
+            )
+            for source_id in dict.fromkeys(source_ids)
+        }
+        related_texts_by_source: dict[str, list[RelatedText]] = {}
+        for source_id, future in futures.items():
+            try:
+                related_texts_by_source[source_id] = future.result()
+            except psycopg2.errors.QueryCanceled:
+                # statement_timeout hit, a slow source should not fail the whole query
+                logger.warning(f"Query for source {source_id} timed out, skipping it.")
+                related_texts_by_source[source_id] = []
+        return related_texts_by_source
+
+    def close(self, timeout: float = None) -> bool:
+        self.executor.shutdown(wait=True)
+        return self.pool.close(timeout)
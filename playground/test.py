@@ -1,16 +1,24 @@
 from playground.utils import TextCleaner
+from playground.batching import MicroBatcher
+from playground.verses import VerseMatrix
+from playground.cache import Cache, cache_key
+from playground.embedding_store import EmbeddingStore
+from playground.embedders import load_embedder, embedder_id, truncate
 import os
+import re
+import hashlib
 import psycopg2
+import psycopg2.errors
 from pgvector.psycopg2 import register_vector
-from pgvector.vector import Vector
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
-import torch
 from dataclasses import dataclass, field
+from functools import cached_property
 import numpy as np
-from psycopg2.extensions import register_adapter, AsIs
+from psycopg2.extensions import register_adapter, adapt, AsIs
 import logging
-from functools import lru_cache
+import threading
+from collections import OrderedDict
+from cachetools import LRUCache
 
 register_adapter(np.int64, lambda v: AsIs(int(v)))
 register_adapter(np.int32, lambda v: AsIs(int(v)))
@@ -20,6 +28,10 @@ cleaner = TextCleaner()
 
 load_dotenv()
 def setup_logger(app_name="logs"):
+    logger = logging.getLogger(app_name)
+    # idempotent, every lazy entry point (model, connection, warm-up) calls it
+    if logger.handlers:
+        return logger
     log_dir = "logs"
     log_file_name = f"{app_name}.log"
     log_file_path = os.path.join(log_dir, log_file_name)
@@ -29,7 +41,6 @@ def setup_logger(app_name="logs"):
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
-    logger = logging.getLogger(app_name)
     logger.setLevel(logging.DEBUG)
 
     file_handler = logging.FileHandler(log_file_path, mode="a")
@@ -55,20 +66,74 @@ def setup_logger(app_name="logs"):
 
     return logger
 
-logger = setup_logger()
+# handlers are attached on first use (see `setup_logger`), so importing this module has no side effects
+logger = logging.getLogger("logs")
 model = os.environ.get("EMBEDDING_MODEL")
-device = "cuda" if torch.cuda.is_available() else "cpu"
-logger.info(f"Loading model")
-transformer = SentenceTransformer(model, device=device)
+VECTOR_DIM = int(os.environ.get("VECTOR_DIM", 768))
+# how queries are encoded, see playground/embedders.py
+backend = os.environ.get("EMBEDDING_BACKEND", "torch")
+_transformer = None
+_transformer_lock = threading.Lock()
+
+
+def get_transformer():
+    """
+    The query encoder on the configured backend, loaded on first use (the model takes seconds to load)
+    """
+    global _transformer
+    if _transformer is None:
+        with _transformer_lock:
+            if _transformer is None:
+                setup_logger()
+                logger.info(f"Loading model on the {backend} backend")
+                _transformer = load_embedder(model, backend)
+    return _transformer
+
+
+class Float32VectorAdapter:
+    """
+    Quotes numpy vectors with the shortest repr of each float32 (exact for float32 embeddings),
+    which is about half the text pgvector's adapter sends with its float64 reprs.
+    Wrap the embedding parameters of a query in it; other numpy arrays keep pgvector's adapter
+    """
+
+    def __init__(self, value: np.ndarray):
+        self._value = value
+
+    def __conform__(self, protocol):
+        # psycopg2 adapts a parameter that conforms to its quoting protocol as is, without a registered adapter
+        if protocol is psycopg2.extensions.ISQLQuote:
+            return self
 
+    def getquoted(self) -> bytes:
+        values = np.asarray(self._value, dtype=np.float32).astype(str)
+        return ("'[" + ",".join(values) + "]'").encode("ascii")
 
-def connect():
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """
+    A connection that keeps track of the statements PREPAREd on it (they live as long as its session).
+    Only the `max_prepared` most recently used ones are kept, the others are DEALLOCATEd
+    """
+
+    max_prepared = int(os.environ.get("DB_MAX_PREPARED", 128))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # SQL text -> statement name, least recently used first
+        self.prepared: OrderedDict[str, str] = OrderedDict()
+
+
+def connect(**kwargs):
+    setup_logger()
     conn = psycopg2.connect(
         database=os.environ.get("DB_NAME"),
         user=os.environ.get("DB_USER"),
         password=os.environ.get("DB_PASSWORD"),
         host=os.environ.get("DB_HOST"),
         port=os.environ.get("DB_PORT"),
+        connection_factory=PreparingConnection,
+        **kwargs,
     )
     register_vector(conn)
     return conn
@@ -97,23 +162,218 @@ def execute_query(
         raise
 
 
-@lru_cache(maxsize=100_000)
-def _embed_cached(text: str) -> tuple:
-    logger.info("Embedding text (cached)")
-    cleaned = cleaner.cleanText(text)
-    vec = transformer.encode(cleaned, normalize_embeddings=True)
-    return tuple(vec.tolist())
+# the named parameters of prepared statements and their types
+PARAM_TYPES = {
+    "embedding": "vector",
+    "coarse": "vector",
+    "count": "int",
+    "oversampled": "int",
+}
+PARAM_PATTERN = re.compile(r"%\((\w+)\)s")
 
 
-def embed(text: str) -> Vector:
-    return Vector(_embed_cached(text))
+def execute_prepared(
+    cursor: psycopg2.extensions.cursor,
+    conn: psycopg2.extensions.connection,
+    sql: str,
+    params: dict,
+    before: str = "",
+):
+    """
+    Runs `sql` (with `%(name)s` parameters typed by PARAM_TYPES) as a prepared statement of the connection:
+    it is PREPAREd on first use and later calls only send an EXECUTE with the parameters, so Postgres
+    skips parsing and (after a few executions) reuses its plan. Each parameter is sent once, however often
+    the query uses it. `before` (e.g. a SET LOCAL) runs first, in the same round trip
+    """
+    prepared: OrderedDict[str, str] | None = getattr(conn, "prepared", None)
+    if prepared is None:
+        # a plain connection that was not opened by `connect()`
+        execute_query(cursor, conn, before + sql, params)
+        return
+    names = list(dict.fromkeys(PARAM_PATTERN.findall(sql)))
+    name = prepared.get(sql)
+    if name is None:
+        name = _prepare(cursor, conn, sql, names)
+    else:
+        prepared.move_to_end(sql)
+    placeholders = f" ({', '.join(['%s'] * len(names))})" if names else ""
+    values = [params[n] for n in names]
+    try:
+        execute_query(cursor, conn, f"{before}EXECUTE {name}{placeholders};", values)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # gone from the session (e.g. DISCARD ALL), prepare it again
+        prepared.pop(sql, None)
+        name = _prepare(cursor, conn, sql, names)
+        execute_query(cursor, conn, f"{before}EXECUTE {name}{placeholders};", values)
+
+
+def _prepare(
+    cursor: psycopg2.extensions.cursor,
+    conn: psycopg2.extensions.connection,
+    sql: str,
+    names: list[str],
+) -> str:
+    if len(conn.prepared) >= conn.max_prepared:
+        _, evicted = conn.prepared.popitem(last=False)
+        execute_query(cursor, conn, f"DEALLOCATE {evicted};")
+    name = "q_" + hashlib.sha1(sql.encode("utf-8")).hexdigest()[:16]
+    numbered = PARAM_PATTERN.sub(lambda match: f"${names.index(match.group(1)) + 1}", sql)
+    types = f" ({', '.join(PARAM_TYPES[n] for n in names)})" if names else ""
+    try:
+        execute_query(cursor, conn, f"PREPARE {name}{types} AS {numbered}")
+    except psycopg2.errors.DuplicatePreparedStatement:
+        # already prepared on this session, by a call that failed before it could be recorded
+        pass
+    conn.prepared[sql] = name
+    return name
+
+
+def _encode_batch(texts: list[str]) -> np.ndarray:
+    logger.info(f"Encoding a batch of {len(texts)} texts")
+    return get_transformer().encode(texts, normalize_embeddings=True, batch_size=len(texts))
+
+
+# concurrent embed requests (from all server threads) are encoded together, one `encode` per micro-batch
+encoder = MicroBatcher(
+    _encode_batch,
+    max_batch_size=int(os.environ.get("EMBED_BATCH_SIZE", 32)),
+    max_wait=float(os.environ.get("EMBED_MAX_WAIT_MS", 5)) / 1000,
+    name="embedding-batcher",
+)
+# cleaned text -> embedding, kept as read-only float32 arrays (3 KB per 768-dim vector)
+_embedding_cache: LRUCache = LRUCache(maxsize=100_000)
+_embedding_cache_lock = threading.Lock()
+# on-disk cache behind it, shared by all processes and kept across restarts, opened on first use
+_embedding_store: EmbeddingStore | None = None
+
+
+def get_embedding_store() -> EmbeddingStore | None:
+    global _embedding_store
+    if _embedding_store is None and os.environ.get("EMBEDDING_CACHE_PATH"):
+        with _embedding_cache_lock:
+            if _embedding_store is None:
+                # keyed by backend too, quantized embeddings are close to but not the same as the reference ones
+                _embedding_store = EmbeddingStore(
+                    os.environ["EMBEDDING_CACHE_PATH"], embedder_id(model, backend)
+                )
+    return _embedding_store
+
+
+def embed_many(texts: list[str]) -> list[np.ndarray]:
+    """
+    Embeds several texts at once: cached embeddings (in memory, then on disk) are reused and all the
+    others are handed to the encoder together, so they are encoded in as few batches as possible
+    """
+    cleaned = [cleaner.cleanText(text) for text in texts]
+    with _embedding_cache_lock:
+        vectors = {text: _embedding_cache.get(text) for text in cleaned}
+    missing = [text for text, vec in vectors.items() if vec is None]
+    embedding_store = get_embedding_store() if missing else None
+    found: dict[str, np.ndarray] = {}
+    if missing and embedding_store is not None:
+        found.update(embedding_store.get_many(missing))
+        missing = [text for text in missing if text not in found]
+    if missing:
+        futures = encoder.submit_many(missing)
+        encoded = {text: future.result() for text, future in zip(missing, futures)}
+        if embedding_store is not None:
+            embedding_store.put_many(encoded)
+        found.update(encoded)
+    if found:
+        with _embedding_cache_lock:
+            for text, vec in found.items():
+                # a copy, so cached rows do not keep their whole encoded batch alive
+                vec = np.array(vec, dtype=np.float32)
+                # shared between requests, so nobody may modify it in place
+                vec.flags.writeable = False
+                vectors[text] = _embedding_cache[text] = vec
+    return [vectors[text] for text in cleaned]
+
+
+def embed(text: str) -> np.ndarray:
+    return embed_many([text])[0]
 
 
 def get_similarity(text: str, query: str) -> float:
-    text_vec = embed(text)
-    query_vec = embed(query)
-    similarity = sum(t * q for t, q in zip(text_vec.to_list(), query_vec.to_list()))
-    return similarity
+    return float(np.dot(embed(text), embed(query)))
+
+
+def warm_up():
+    """
+    Pays the startup costs up front (log handlers, model load and a first encode) instead of on the first request.
+    Retrievers connect and load their sources lazily too, see `RetrieverBySource.warm_up`
+    """
+    setup_logger()
+    logger.info("Warming up the embedding model")
+    _encode_batch(["warm up"])
+
+
+class LazyConnection:
+    """
+    Opens the connection (and its cursor) on first use instead of at construction,
+    unless one is passed in explicitly
+    """
+
+    def __init__(self, conn: psycopg2.extensions.connection = None):
+        self._conn = conn
+        self._cursor = None
+
+    @property
+    def conn(self) -> psycopg2.extensions.connection:
+        if self._conn is None:
+            self._conn = connect()
+        return self._conn
+
+    @property
+    def cursor(self) -> psycopg2.extensions.cursor:
+        if self._cursor is None:
+            self._cursor = self.conn.cursor()
+        return self._cursor
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = self._cursor = None
+
+
+# attaches to each candidate chunk (from a `candidates` CTE) its whole tafsir paragraph (the ordered chunks of
+# related_text_group, the chunk is marked by $$...$$ in `process_rows`), its source and related sentences:
+# the `span` verses from `aya` in `sura`, with each one's similarity to the query (from its stored embedding)
+# takes the query embedding as its `embedding` parameter
+MERGE_SIBLINGS_SQL = """
+                scored AS (
+                SELECT
+                    rt.related_id,
+                    rt.source_id,
+                    rt.tafsir_prefix,
+                    rt.part_no,
+                    rt.details,
+                    rt.sura,
+                    rt.aya,
+                    rt.span,
+                    (rt.embedding <=> %(embedding)s) AS rt_distance
+                FROM related_text rt
+                JOIN candidates c USING (related_id, source_id)
+                )
+                SELECT
+                t.related_id,
+                -- a chunk without a group row (loaded after the groups were built) stands alone
+                COALESCE(g.details, ARRAY[t.details]),
+                CASE WHEN g.details IS NULL THEN 0 ELSE t.part_no END,
+                src.source_id, src.source_type, src.author, src.date_info, src.concept, src.title,
+                t.rt_distance,
+                snt.sentence_id, snt.section_id, snt.text,
+                1 - (snt.embedding <=> %(embedding)s) AS sentence_similarity
+                FROM scored t
+                LEFT JOIN related_text_group g ON g.tafsir_prefix = t.tafsir_prefix
+                LEFT JOIN related_text_source src ON src.source_id = t.source_id
+                LEFT JOIN sentence snt
+                ON snt.section_id = t.sura
+                AND snt.sentence_id BETWEEN t.aya AND t.aya + t.span - 1
+                ORDER BY t.rt_distance;
+            """
 
 
 @dataclass(eq=True)
@@ -220,17 +480,24 @@ class Result:
         return result
 
 
-class SentenceRetriever:
-    """Directly queries on the sentence table"""
+class SentenceRetriever(LazyConnection):
+    """Directly queries on the sentence table (or on its in-memory copy if `verses` is given)"""
 
-    def __init__(self, conn: psycopg2.extensions.connection = connect()):
-        self.conn = conn
-        self.cursor = conn.cursor()
+    def __init__(
+        self,
+        conn: psycopg2.extensions.connection = None,
+        verses: VerseMatrix = None,
+    ):
+        super().__init__(conn)
+        self.verses = verses
 
     def retrieve_by_count(
         self, user_query: str, count: int, sql_query: str = None
     ) -> list[Sentence]:
         embedding = embed(user_query)
+        if sql_query is None and self.verses is not None:
+            rows = self.verses.top_k(embedding, count)
+            return [Sentence(*row) for row in rows]
         if sql_query is None:
             sql_query = """
                 SELECT sentence_id, section_id, text, (embedding <=> %s) AS distance
@@ -238,92 +505,69 @@ class SentenceRetriever:
                 ORDER BY distance
                 LIMIT %s
             """
-        execute_query(self.cursor, self.conn, sql_query, (embedding, count))
+        execute_query(
+            self.cursor, self.conn, sql_query, (Float32VectorAdapter(embedding), count)
+        )
         rows = self.cursor.fetchall()
         return [Sentence(*row) for row in rows]
 
-    def close(self):
-        self.cursor.close()
-        self.conn.close()
-
 
-class RelatedTextRetriever:
-    def __init__(self, conn: psycopg2.extensions.connection = connect()):
-        self.conn = conn
-        self.cursor = conn.cursor()
+class RelatedTextRetriever(LazyConnection):
+    def __init__(self, conn: psycopg2.extensions.connection = None):
+        super().__init__(conn)
 
     def retrieve_by_count(
         self, user_query: str, count: int, sql_query: str = None
     ) -> list[RelatedText]:
-        embedding = embed(user_query)
-        if sql_query is None:
-            sql_query = """
+        """
+        A custom `sql_query` gets the `embedding` and `count` named parameters (`%(embedding)s`)
+        """
+        params = {"embedding": Float32VectorAdapter(embed(user_query)), "count": count}
+        if sql_query is not None:
+            return self.process_rows(self.run_query(sql_query, params))
+        sql_query = (
+            """
                 WITH candidates AS (
                 SELECT rt.related_id, rt.source_id
                 FROM related_text rt
                 WHERE rt.embedding IS NOT NULL
-                ORDER BY rt.embedding <=> %s
-                LIMIT %s
-                ),
-                scored AS (
-                SELECT
-                    rt.related_id,
-                    rt.source_id,
-                    (rt.embedding <=> %s) AS rt_distance,
-                    split_part(rt.related_id,'_',1) AS p1,
-                    split_part(rt.related_id,'_',2) AS p2,
-                    split_part(rt.related_id,'_',3) AS p3,
-                    split_part(rt.related_id,'_',4) AS p4,
-                    split_part(rt.related_id,'_',5) AS p5,
-                    (split_part(rt.related_id,'_',6))::int AS part_no
-                FROM related_text rt
-                JOIN candidates c USING (related_id, source_id)
+                ORDER BY rt.embedding <=> %(embedding)s
+                LIMIT %(count)s
                 ),
-                siblings AS (
-                SELECT
-                    t.related_id AS target_id,
-                    string_agg(
-                        CASE WHEN r.related_id = t.related_id
-                            THEN '$$' || r.details || '$$'
-                            ELSE r.details
-                        END,
-                        ' ' ORDER BY (split_part(r.related_id,'_',6))::int
-                    ) AS merged_details
-                FROM related_text r
-                JOIN scored t
-                ON split_part(r.related_id,'_',1) = t.p1
-                AND split_part(r.related_id,'_',2) = t.p2
-                AND split_part(r.related_id,'_',3) = t.p3
-                AND split_part(r.related_id,'_',4) = t.p4
-                AND split_part(r.related_id,'_',5) = t.p5
-                GROUP BY t.related_id
-                )
-                SELECT
-                t.related_id,
-                s.merged_details AS details,
-                src.source_id, src.source_type, src.author, src.date_info, src.concept, src.title,
-                t.rt_distance,
-                snt.sentence_id, snt.section_id, snt.text
-                FROM scored t
-                JOIN siblings s ON s.target_id = t.related_id
-                LEFT JOIN related_text_source src ON src.source_id = t.source_id
-                LEFT JOIN relationship rel
-                ON rel.related_text_id_prefix = concat_ws('_', t.p1, t.p2, t.p3, t.p4, t.p5)
-                LEFT JOIN sentence snt ON (snt.sentence_id, snt.section_id) = (rel.sentence_id, rel.section_id)
-                ORDER BY t.rt_distance;
-            """
+                """
+            + MERGE_SIBLINGS_SQL
+        )
+        return self.process_rows(self.run_query(sql_query, params, prepare=True))
 
-        execute_query(self.cursor, self.conn, sql_query, (embedding, count, embedding))
-        return self.process_rows(self.cursor.fetchall())
+    def run_query(
+        self, sql_query: str, params=None, prepare: bool = False, before: str = ""
+    ) -> list[tuple]:
+        """
+        Runs `sql_query` and returns its rows, as a prepared statement if `prepare` (see `execute_prepared`)
+        """
+        if prepare:
+            execute_prepared(self.cursor, self.conn, sql_query, params, before)
+        else:
+            execute_query(self.cursor, self.conn, before + sql_query, params)
+        rows = self.cursor.fetchall()
+        if before:
+            # ends the transaction, and with it the SET LOCALs of `before`, so they do not apply to the next queries
+            self.conn.rollback()
+        return rows
 
     def process_rows(
         self,
-        rows: list[tuple[str, str, str, str, str, str, str, str, float, int, int, str]],
+        rows: list[
+            tuple[
+                str, list[str], int, str, str, str, str, str, str, float, int, int, str, float
+            ]
+        ],
     ) -> list[RelatedText]:
         related_texts_as_dict: dict[str, RelatedText] = {}
         for (
             related_id,
-            details,
+            paragraph,
+            part_no,
             source_id,
             source_type,
             author,
@@ -334,6 +578,7 @@ class RelatedTextRetriever:
             sentence_id,
             section_id,
             text,
+            sentence_similarity,
         ) in rows:
             if related_id not in related_texts_as_dict:
                 src = Source(
@@ -348,7 +593,7 @@ class RelatedTextRetriever:
                     related_text_id=related_id,
                     related_sentences=[],
                     source=src,
-                    details=details,
+                    details=mark_chunk(paragraph, part_no),
                     similarity=1 - rt_distance,
                 )
             related_texts_as_dict[related_id].related_sentences.append(
@@ -356,7 +601,10 @@ class RelatedTextRetriever:
                     sentence_id=sentence_id,
                     section_id=section_id,
                     text=text,
-                    similarity=-1,
+                    # NULL until the sentence is embedded
+                    similarity=(
+                        sentence_similarity if sentence_similarity is not None else -1
+                    ),
                 )
             )
 
@@ -388,15 +636,52 @@ class RelatedTextRetriever:
 
 
 class RetrieverBySource(RelatedTextRetriever):
-    def __init__(self, conn: psycopg2.extensions.connection = connect(), **kwargs):
-        self.conn = conn
-        self.cursor = conn.cursor()
-        self.source_ids, self.sources = self.get_source_ids()
+    def __init__(self, conn: psycopg2.extensions.connection = None, **kwargs):
+        # connects on first use, subclasses that manage their own connections override `run_query`
+        super().__init__(conn)
         self.base = kwargs.get("base", 0.3)
         self.sentence_threshold = kwargs.get("sentence_threshold", 0.5)
         self.rt_threshold = kwargs.get("rt_threshold", 0.4)
         self.balance_threshold = kwargs.get("balance_threshold", 0.9)
-        self.source_by_id = {source.get("source_id"): source for source in self.sources}
+        # fetch the candidates of all sources in one statement instead of one per source
+        self.single_query = kwargs.get("single_query", True)
+        # in-memory verse embeddings used for the final rescoring, see `load_verses`
+        self.verses: VerseMatrix | None = kwargs.get("verses")
+        # results of previous queries, see `retrieve`
+        self.cache: Cache | None = kwargs.get("cache")
+        # two-stage search: `oversample` times `count` candidates from an approximate first stage, reranked on
+        # the full embedding. The first stage is either the `coarse_dim`-dim Matryoshka prefix (embedding_coarse, see
+        # db/create_coarse_embeddings.py) or a `quantization` ("halfvec" or "binary") of the embedding
+        # (see db/create_quantized_indexes.py)
+        self.coarse_dim: int | None = kwargs.get("coarse_dim")
+        self.quantization: str | None = kwargs.get("quantization")
+        if self.quantization not in (None, "halfvec", "binary"):
+            raise ValueError(f"Unknown quantization {self.quantization!r}")
+        self.oversample = kwargs.get("oversample", 4)
+
+    # the available sources are fetched once, on first use
+    @cached_property
+    def sources(self) -> list[dict]:
+        _, sources = self.get_source_ids()
+        return sources
+
+    @cached_property
+    def source_ids(self) -> list[str]:
+        return [source.get("source_id") for source in self.sources]
+
+    @cached_property
+    def source_by_id(self) -> dict[str, dict]:
+        return {source.get("source_id"): source for source in self.sources}
+
+    def warm_up(self, verses_cache_path: str = None):
+        """
+        Loads the model, the available sources and (if `verses_cache_path` is given) the verse embeddings
+        now rather than on the first query
+        """
+        warm_up()
+        logger.info(f"{len(self.source_ids)} sources available")
+        if verses_cache_path is not None:
+            self.load_verses(verses_cache_path)
 
     def get_source_ids(self) -> tuple[list[str], list[dict]]:
         sql_query = """
@@ -409,11 +694,20 @@ class RetrieverBySource(RelatedTextRetriever):
             SELECT * FROM related_text_source
             WHERE source_id IN (SELECT source_id FROM source_ids)
         """
-        execute_query(self.cursor, self.conn, sql_query)
-        sources = [Source(*row).to_dict() for row in self.cursor.fetchall()]
+        sources = [Source(*row).to_dict() for row in self.run_query(sql_query)]
         source_ids = [source.get("source_id") for source in sources]
         return source_ids, sources
 
+    def load_verses(self, cache_path: str = None) -> VerseMatrix:
+        """
+        Loads all sentence embeddings in memory (from `cache_path` if still valid), so that
+        `merge_sentences` rescores verses with a matrix product
+        """
+        logger.info("Loading verse embeddings")
+        self.verses = VerseMatrix.load(self.run_query, cache_path, model)
+        logger.info(f"Loaded {len(self.verses)} verse embeddings")
+        return self.verses
+
     def retrieve_by_source_id(
         self,
         user_query: str,
@@ -423,69 +717,145 @@ class RetrieverBySource(RelatedTextRetriever):
         if source_id not in self.source_ids:
             logger.error(f"Source ID {source_id} not found in available sources.")
             return []
-        sql_query = f"""
-                WITH candidates AS (
+        sql_query = (
+            """
+                WITH candidates AS ("""
+            + self.source_candidates(source_id)
+            + """
+                ),
+            """
+            + MERGE_SIBLINGS_SQL
+        )
+        rows = self.run_query(
+            sql_query,
+            self.query_params(embed(user_query), count),
+            prepare=True,
+            before=self.search_settings(count),
+        )
+        return self.process_rows(rows)
+
+    def first_stage(self) -> tuple[str, str] | None:
+        """
+        The approximate search run before the full-precision rerank, as (column that must not be NULL,
+        distance expression), or None for a single full-precision search.
+        The expressions match the ones indexed by db/create_coarse_embeddings.py and db/create_quantized_indexes.py
+        """
+        if self.coarse_dim:
+            return "rt.embedding_coarse", "rt.embedding_coarse <=> %(coarse)s"
+        if self.quantization == "halfvec":
+            return (
+                "rt.embedding",
+                f"rt.embedding::halfvec({VECTOR_DIM}) <=> %(embedding)s::halfvec({VECTOR_DIM})",
+            )
+        if self.quantization == "binary":
+            return (
+                "rt.embedding",
+                f"binary_quantize(rt.embedding)::bit({VECTOR_DIM}) <~> binary_quantize(%(embedding)s)",
+            )
+        return None
+
+    def search_settings(self, count: int) -> str:
+        """
+        Statements to run before the candidates query, in its transaction.
+        An HNSW scan returns at most `hnsw.ef_search` (default 40) rows, so the oversampled first stage needs more
+        """
+        if self.coarse_dim or self.quantization:
+            return f"SET LOCAL hnsw.ef_search = {max(40, count * self.oversample)};"
+        return ""
+
+    def query_params(self, embedding: np.ndarray, count: int) -> dict:
+        """
+        The named parameters of the candidates and merge queries
+        """
+        params = {"embedding": Float32VectorAdapter(embedding), "count": count}
+        if self.coarse_dim:
+            params["coarse"] = Float32VectorAdapter(truncate(embedding, self.coarse_dim))
+        if self.coarse_dim or self.quantization:
+            params["oversampled"] = count * self.oversample
+        return params
+
+    def source_candidates(self, source_id: str) -> str:
+        """
+        The `SELECT related_id, source_id` of the `count` chunks of a source nearest to the query (see `query_params`).
+        With a first stage (coarse or quantized, see `first_stage`) its nearest `count * oversample` chunks
+        are reranked by their full embedding.
+        The source is a literal, not a parameter: the partial HNSW index of a source is only used when the planner
+        sees its source_id, so every source gets its own prepared statement (and plan)
+        """
+        source = adapt(source_id).getquoted().decode()
+        first_stage = self.first_stage()
+        if first_stage is None:
+            return f"""
                 SELECT rt.related_id, rt.source_id
                 FROM related_text rt
-                WHERE rt.source_id = '{source_id}'
+                WHERE rt.source_id = {source}
                 AND rt.embedding IS NOT NULL
-                ORDER BY rt.embedding <=> %s
-                LIMIT %s
-                ),
-                scored AS (
-                SELECT
-                    rt.related_id,
-                    rt.source_id,
-                    (rt.embedding <=> %s) AS rt_distance,
-                    split_part(rt.related_id,'_',1) AS p1,
-                    split_part(rt.related_id,'_',2) AS p2,
-                    split_part(rt.related_id,'_',3) AS p3,
-                    split_part(rt.related_id,'_',4) AS p4,
-                    split_part(rt.related_id,'_',5) AS p5,
-                    (split_part(rt.related_id,'_',6))::int AS part_no
-                FROM related_text rt
-                JOIN candidates c USING (related_id, source_id)
+                ORDER BY rt.embedding <=> %(embedding)s
+                LIMIT %(count)s"""
+        column, distance = first_stage
+        return f"""
+                SELECT c.related_id, c.source_id
+                FROM (
+                    SELECT rt.related_id, rt.source_id, rt.embedding
+                    FROM related_text rt
+                    WHERE rt.source_id = {source}
+                    AND {column} IS NOT NULL
+                    ORDER BY {distance}
+                    LIMIT %(oversampled)s
+                ) c
+                ORDER BY c.embedding <=> %(embedding)s
+                LIMIT %(count)s"""
+
+    def retrieve_by_source_ids(
+        self,
+        user_query: str,
+        source_ids: list[str],
+        count: int,
+    ) -> dict[str, list[RelatedText]]:
+        """
+        Same as calling `retrieve_by_source_id` for each source, but in a single round trip.
+        Every source gets its own parenthesized `ORDER BY ... LIMIT` branch in the candidates CTE,
+        so each branch can still use the per-source HNSW index of its source
+        """
+        related_texts_by_source: dict[str, list[RelatedText]] = {}
+        for source_id in source_ids:
+            if source_id not in self.source_ids:
+                logger.error(f"Source ID {source_id} not found in available sources.")
+                continue
+            related_texts_by_source[source_id] = []
+        if not related_texts_by_source:
+            return related_texts_by_source
+
+        branches = [
+            "(" + self.source_candidates(source_id) + "\n                )"
+            for source_id in related_texts_by_source
+        ]
+        # prepared once per set of sources, so repeated (e.g. all sources) queries reuse it
+        sql_query = (
+            """
+                WITH candidates AS (
+                """
+            + "\n                UNION ALL\n                ".join(branches)
+            + """
                 ),
-                siblings AS (
-                SELECT
-                    t.related_id AS target_id,
-                    string_agg(
-                        CASE WHEN r.related_id = t.related_id
-                            THEN '$$' || r.details || '$$'
-                            ELSE r.details
-                        END,
-                        ' ' ORDER BY (split_part(r.related_id,'_',6))::int
-                    ) AS merged_details
-                FROM related_text r
-                JOIN scored t
-                ON split_part(r.related_id,'_',1) = t.p1
-                AND split_part(r.related_id,'_',2) = t.p2
-                AND split_part(r.related_id,'_',3) = t.p3
-                AND split_part(r.related_id,'_',4) = t.p4
-                AND split_part(r.related_id,'_',5) = t.p5
-                GROUP BY t.related_id
-                )
-                SELECT
-                t.related_id,
-                s.merged_details AS details,
-                src.source_id, src.source_type, src.author, src.date_info, src.concept, src.title,
-                t.rt_distance,
-                snt.sentence_id, snt.section_id, snt.text
-                FROM scored t
-                JOIN siblings s ON s.target_id = t.related_id
-                LEFT JOIN related_text_source src ON src.source_id = t.source_id
-                LEFT JOIN relationship rel
-                ON rel.related_text_id_prefix = concat_ws('_', t.p1, t.p2, t.p3, t.p4, t.p5)
-                LEFT JOIN sentence snt ON (snt.sentence_id, snt.section_id) = (rel.sentence_id, rel.section_id)
-                ORDER BY t.rt_distance;
             """
-
-        return self.retrieve_by_count(user_query, count, sql_query)
+            + MERGE_SIBLINGS_SQL
+        )
+        rows = self.run_query(
+            sql_query,
+            self.query_params(embed(user_query), count),
+            prepare=True,
+            before=self.search_settings(count),
+        )
+        # rows are ordered by distance, so each source keeps the order `retrieve_by_source_id` gives
+        for rt in self.process_rows(rows):
+            related_texts_by_source[rt.source.source_id].append(rt)
+        return related_texts_by_source
 
     def retrieve(self, user_query: str, source_ids: list[str], count: int) -> Result:
         """
         Does the following:
-        1. For each source, retrieves the top `count` candidate related text chunks
+        1. For each source, retrieves the top `count` candidate related text chunks (in a single query unless `single_query` is off)
         2. These chunks are then merged together with ther siblings to form the entire related_text paragraph, we also mark this related_text by ...$$this is the relevant part$$...
         3. After this step, the related_text : list[sentence] becomes sentence_related_texts: list[RT]
         4. A score is calculated for each sentence from its related text from this source only
@@ -493,11 +863,45 @@ class RetrieverBySource(RelatedTextRetriever):
         6. we cut-off any sentences that seem to be below a threshold
         7. for each sentence's related text, we cut-off any related text that is also below a threshold
         8. Postprocess to get a Result Object and return It
+        Results are cached (if a cache is set) per normalized query, set of sources and scoring settings
+        """
+        if self.cache is None:
+            return self.search(user_query, source_ids, count)
+        key = cache_key(
+            embedder_id(model, backend),
+            cleaner.cleanText(user_query),
+            sorted(set(source_ids)),
+            count,
+            self.base,
+            self.sentence_threshold,
+            self.rt_threshold,
+            self.balance_threshold,
+            self.coarse_dim,
+            self.quantization,
+            self.oversample,
+        )
+        result = self.cache.get(key)
+        if result is None:
+            result = self.search(user_query, source_ids, count)
+            self.cache.set(key, result)
+        return result
+
+    def search(self, user_query: str, source_ids: list[str], count: int) -> Result:
+        """
+        `retrieve` without the cache
         """
         results: list[SentenceRelatedTexts] = []
-        for source_id in source_ids:
+        if self.single_query:
+            related_texts_by_source = self.retrieve_by_source_ids(
+                user_query, source_ids, count
+            )
+        else:
             # get the rt per source
-            related_texts = self.retrieve_by_source_id(user_query, source_id, count)
+            related_texts_by_source = {
+                source_id: self.retrieve_by_source_id(user_query, source_id, count)
+                for source_id in source_ids
+            }
+        for related_texts in related_texts_by_source.values():
             # transform data
             result = self.related_texts_to_sentences(related_texts)
             # calculate score per source
@@ -542,11 +946,10 @@ class RetrieverBySource(RelatedTextRetriever):
             )
         # sort sentences by section id then sentence id
         sentences_with_relations.sort(key=lambda x: (x.section_id, x.sentence_id))
-        all_related_texts: set[str] = set()
         # sort related texts by order they appear in for the sentences
+        all_related_texts: dict[str, None] = {}
         for sentence in sentences_with_relations:
-            for related_text_id in sentence.related_text_ids:
-                all_related_texts.add(related_text_id)
+            all_related_texts.update(dict.fromkeys(sentence.related_text_ids))
         related_texts = [unique_related_texts[rt_id] for rt_id in all_related_texts]
         result = Result(sentences=sentences_with_relations, related_texts=related_texts)
         return result
@@ -556,22 +959,17 @@ class RetrieverBySource(RelatedTextRetriever):
     ) -> list[SentenceRelatedTexts]:
         """
         Transforms the returned values from RT: list[S] to S: list[RT]
-        It also calculates the score for the sentence based on its related text
+        Each (related text, sentence) pair gives its own entry, they get grouped per sentence in `merge_sentences`.
+        (This used to search the list for the sentence, which was quadratic and never matched anyway:
+        a Sentence never compares equal to a SentenceRelatedTexts, so the scores were always per pair)
         """
-        sentence_related_texts: list[SentenceRelatedTexts] = list()
-        for rt in related_texts:
-            for sentence in rt.related_sentences:
-                if sentence in sentence_related_texts:
-                    idx = sentence_related_texts.index(sentence)
-                    sentence_related_texts[idx].related_texts.append(rt)
-                    sentence_related_texts[idx].score.append(rt.similarity)
-                else:
-                    sentence_related_texts.append(
-                        SentenceRelatedTexts(
-                            sentence=sentence, related_texts=[rt], score=[rt.similarity]
-                        )
-                    )
-        return sentence_related_texts
+        return [
+            SentenceRelatedTexts(
+                sentence=sentence, related_texts=[rt], score=[rt.similarity]
+            )
+            for rt in related_texts
+            for sentence in rt.related_sentences
+        ]
 
     def score_sentence(self, sentence_related_text: SentenceRelatedTexts) -> float:
         """
@@ -588,17 +986,10 @@ class RetrieverBySource(RelatedTextRetriever):
             else:
                 related_text_id_counts[prefix].append(related_text.similarity)
         # now for each one, compute a similarity score using a power series
-        related_text_id_scores: dict[str, float] = {}
-        for prefix, similarities in related_text_id_counts.items():
-            related_text_id_scores[prefix] = self.get_score(similarities)
-
-        related_text_id_scores = dict(
-            sorted(
-                related_text_id_scores.items(), key=lambda item: item[1], reverse=True
-            )
+        # (get_score sorts the values itself)
+        score = self.get_score(
+            [self.get_score(similarities) for similarities in related_text_id_counts.values()]
         )
-
-        score = self.get_score(related_text_id_scores.values())
         return score
 
     def get_score(self, vals: list[float]) -> float:
@@ -613,10 +1004,10 @@ class RetrieverBySource(RelatedTextRetriever):
         Merges the sentences' related texts from all the different sources
         Also re-calculates the final scores for each sentence
         """
-        merged: dict[str, SentenceRelatedTexts] = {}
+        merged: dict[tuple[int, int], SentenceRelatedTexts] = {}
         for sentence_related_text in sentence_related_texts:
             sentence = sentence_related_text.sentence
-            key = f"{sentence.sentence_id}_{sentence.section_id}"
+            key = (sentence.sentence_id, sentence.section_id)
             if key not in merged:
                 merged[key] = sentence_related_text
             else:
@@ -624,11 +1015,31 @@ class RetrieverBySource(RelatedTextRetriever):
                 merged[key].score.extend(sentence_related_text.score)
         # here, each object has the score a list of scores across different sources
         sentences = sorted(merged.values(), key=lambda x: max(x.score), reverse=True)
-        for sentence in sentences:
-            sentence.final_score = self.get_score(sentence.score)
-            sentence.final_score = self.balance_threshold * sentence.final_score + (
-                1 - self.balance_threshold
-            ) * get_similarity(sentence.sentence.text, user_query)
+        # the query similarity of each sentence comes with the candidates (from its stored embedding),
+        # only sentences that are not embedded in the database yet go through the model
+        similarities = np.array(
+            [sentence.sentence.similarity for sentence in sentences], dtype=np.float32
+        )
+        if self.verses is not None and sentences:
+            in_memory = self.verses.similarity_of(
+                [
+                    (sentence.sentence.sentence_id, sentence.sentence.section_id)
+                    for sentence in sentences
+                ],
+                embed(user_query),
+            )
+            similarities = np.where(np.isnan(in_memory), similarities, in_memory)
+        missing = np.flatnonzero(similarities == -1)
+        if missing.size:
+            query_vec = embed(user_query)
+            sentence_vecs = embed_many([sentences[i].sentence.text for i in missing])
+            similarities[missing] = np.stack(sentence_vecs) @ query_vec
+        scores = np.array([self.get_score(sentence.score) for sentence in sentences])
+        final_scores = self.balance_threshold * scores + (
+            1 - self.balance_threshold
+        ) * similarities
+        for sentence, final_score in zip(sentences, final_scores):
+            sentence.final_score = float(final_score)
         # now each sentence has its final score
         return sentences
 
@@ -636,8 +1047,15 @@ class RetrieverBySource(RelatedTextRetriever):
         self,
         results: list[SentenceRelatedTexts],
     ) -> list[SentenceRelatedTexts]:
+        # we need to delete sentences that have a final score below the threshold
+        # (done first, so related texts are only merged for the sentences that are kept)
+        filtered_results = [
+            sentence
+            for sentence in results
+            if sentence.final_score >= self.sentence_threshold
+        ]
         # for significant related_texts that have same content without the $$ signed, we need to merge them, preserving the $$ signs, and mix their scores
-        for sentence in results:
+        for sentence in filtered_results:
             rt_by_prefix: dict[str, list[RelatedText]] = {}
             for rt in sentence.related_texts:
                 prefix = rt.related_text_id.rsplit("_", 1)[0]
@@ -658,24 +1076,24 @@ class RetrieverBySource(RelatedTextRetriever):
                     similarity=self.get_score([rt.similarity for rt in rts]),
                 )
                 merged_rts.append(rt)
-            sentence.related_texts = merged_rts
-
-        filtered_results: list[SentenceRelatedTexts] = []
-        # we need to delete sentences that have a final score below the threshold
-        for sentence in results:
-            if sentence.final_score >= self.sentence_threshold:
-                filtered_results.append(sentence)
-        # now for the remaining sentences, filter the related texts with a low contribution
-        for sentence in filtered_results:
+            # now filter the related texts with a low contribution
             sentence.related_texts = [
-                rt
-                for rt in sentence.related_texts
-                if rt.similarity >= self.rt_threshold
+                rt for rt in merged_rts if rt.similarity >= self.rt_threshold
             ]
 
         return filtered_results
 
 
+def mark_chunk(paragraph: list[str], part_no: int) -> str:
+    """
+    Joins the chunks of a tafsir paragraph, with chunk `part_no` between $$ signs
+    """
+    return " ".join(
+        "$$" + details + "$$" if i == part_no else details
+        for i, details in enumerate(paragraph)
+    )
+
+
 def merge_details(strings: list[str]) -> str:
     """
     This function merges a list of such strings into one
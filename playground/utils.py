@@ -2,6 +2,11 @@ import google.generativeai as genai
 from pyarabic import araby
 from camel_tools.utils.normalize import normalize_unicode
 import re
+import threading
+import asyncio
+import time
+from typing import AsyncIterator, Iterator
+from playground.cache import Cache, cache_key
 
 ZERO_SPACE_CHAR = "\u200c"
 
@@ -52,12 +57,21 @@ class TextCleaner:
 
 class Gemini:
 
-    def __init__(self, api_keys: list[str], model: str = "gemini-2.5-flash"):
+    def __init__(
+        self,
+        api_keys: list[str],
+        model: str = "gemini-2.5-flash",
+        cache: Cache = None,
+    ):
         if not api_keys:
             raise ValueError("API key not found")
         self._api_keys = api_keys
         self._idx = 0
         self.model_name = model
+        # answers of previous (query, retrieved data) pairs, see `ask`
+        self.cache = cache
+        # requests share one instance, so only one of them should rotate a failing key
+        self._lock = threading.Lock()
         self._set_key(self._idx)
 
     def _set_key(self, idx: int):
@@ -66,20 +80,136 @@ class Gemini:
         genai.configure(api_key=self._api_keys[idx])
         self.model = genai.GenerativeModel(self.model_name)
 
+    def _attempts(self) -> Iterator:
+        """
+        The model to call on each attempt: one attempt per key, starting from the current one. Callers return on
+        success, otherwise the key is rotated before the next attempt
+        """
+        for remaining in range(len(self._api_keys) - 1, -1, -1):
+            idx = self._idx
+            yield self.model
+            print("Permutating Key...")
+            if not remaining:
+                raise Exception("All API keys Exhausted.")
+            self._rotate_from(idx)
+
     def answer_and_rotate(self, prompt: str) -> str:
-        n = len(self._api_keys)
-        while n:
+        for model in self._attempts():
             try:
-                response = self.model.generate_content(prompt)
-                return response.text
+                return model.generate_content(prompt).text
             except Exception:
-                print("Permutating Key...")
-            n -= 1
-            if n == 0:
-                raise Exception("All API keys Exhausted.")
-            self._set_key(self._idx + 1)
+                continue
+
+    async def answer_and_rotate_async(self, prompt: str) -> str:
+        """
+        Same as `answer_and_rotate`, but awaits the API call instead of blocking the thread
+        """
+        for model in self._attempts():
+            try:
+                return (await model.generate_content_async(prompt)).text
+            except Exception:
+                continue
+
+    def answer_and_rotate_stream(self, prompt: str) -> Iterator[str]:
+        """
+        Yields the answer chunk by chunk as the model generates it.
+        Keys are only rotated if the request fails before the first chunk, a retry after that would repeat text
+        """
+        for model in self._attempts():
+            started = False
+            try:
+                for chunk in model.generate_content(prompt, stream=True):
+                    started = True
+                    yield chunk.text
+                return
+            except Exception:
+                if started:
+                    raise
+
+    async def answer_and_rotate_stream_async(self, prompt: str) -> AsyncIterator[str]:
+        """
+        Same as `answer_and_rotate_stream`, but awaits the API instead of blocking the thread
+        """
+        for model in self._attempts():
+            started = False
+            try:
+                async for chunk in await model.generate_content_async(prompt, stream=True):
+                    started = True
+                    yield chunk.text
+                return
+            except Exception:
+                if started:
+                    raise
+
+    def _rotate_from(self, idx: int):
+        with self._lock:
+            # skip if a concurrent request already moved on from this key
+            if self._idx == idx:
+                self._set_key(idx + 1)
+
+    def _cached_answer(self, user_query: str, json_data: str) -> tuple[str, str]:
+        """
+        Returns the cache key of this question and its cached answer (None if not cached)
+        """
+        if self.cache is None:
+            return None, None
+        key = cache_key(self.model_name, user_query, json_data)
+        return key, self.cache.get(key)
+
+    def _cache_answer(self, key: str, answer: str):
+        if self.cache is not None:
+            self.cache.set(key, answer)
 
     def ask(self, user_query: str, json_data: str) -> str:
+        """
+        Answers the query from the retrieved data, identical (query, data) pairs are answered from the cache
+        """
+        key, response = self._cached_answer(user_query, json_data)
+        if response is not None:
+            return response
+        prompt = self.answer_prompt(user_query, json_data)
+        response = self.answer_and_rotate(prompt)
+        self._cache_answer(key, response)
+        return response
+
+    async def ask_async(self, user_query: str, json_data: str) -> str:
+        # the cache may do blocking I/O (SQLite, Redis), so it runs off the event loop
+        key, response = await asyncio.to_thread(self._cached_answer, user_query, json_data)
+        if response is not None:
+            return response
+        prompt = self.answer_prompt(user_query, json_data)
+        response = await self.answer_and_rotate_async(prompt)
+        await asyncio.to_thread(self._cache_answer, key, response)
+        return response
+
+    def ask_stream(self, user_query: str, json_data: str) -> Iterator[str]:
+        key, response = self._cached_answer(user_query, json_data)
+        if response is not None:
+            yield response
+            return
+        prompt = self.answer_prompt(user_query, json_data)
+        chunks: list[str] = []
+        for chunk in self.answer_and_rotate_stream(prompt):
+            chunks.append(chunk)
+            yield chunk
+        self._cache_answer(key, "".join(chunks))
+
+    async def ask_stream_async(
+        self, user_query: str, json_data: str
+    ) -> AsyncIterator[str]:
+        key, response = await asyncio.to_thread(self._cached_answer, user_query, json_data)
+        if response is not None:
+            yield response
+            return
+        prompt = self.answer_prompt(user_query, json_data)
+        chunks: list[str] = []
+        async for chunk in self.answer_and_rotate_stream_async(prompt):
+            chunks.append(chunk)
+            yield chunk
+        await asyncio.to_thread(self._cache_answer, key, "".join(chunks))
+
+    @staticmethod
+    def answer_prompt(user_query: str, json_data: str) -> str:
 
         prompt = f"""Given this JSON data:
 <JSON data>
@@ -111,8 +241,7 @@ Some sample format for your output is as follows:
 ...
 
 """
-        response = self.answer_and_rotate(prompt)
-        return response
+        return prompt
 
     def generate_question(self, text: str) -> str:
 
@@ -131,3 +260,41 @@ Sample output:
 
         response = self.answer_and_rotate(prompt)
         return response
+
+
+class GeminiStub(Gemini):
+    """
+    Drop-in replacement for `Gemini` that never calls the API, for load testing the servers.
+    Every answer takes `delay` seconds (slept, or awaited in the async variants) to mimic the LLM round trip
+    """
+
+    def __init__(
+        self, delay: float = 2.0, model: str = "gemini-stub", cache: Cache = None
+    ):
+        self.delay = delay
+        self.model_name = model
+        self.cache = cache
+
+    def _stub_answer(self, prompt: str) -> str:
+        return f"إجابة تجريبية ({self.model_name}, {len(prompt)} حرف)"
+
+    def answer_and_rotate(self, prompt: str) -> str:
+        time.sleep(self.delay)
+        return self._stub_answer(prompt)
+
+    async def answer_and_rotate_async(self, prompt: str) -> str:
+        await asyncio.sleep(self.delay)
+        return self._stub_answer(prompt)
+
+    def answer_and_rotate_stream(self, prompt: str) -> Iterator[str]:
+        # spread the delay over the words, like tokens arriving from the model
+        words = self._stub_answer(prompt).split(" ")
+        for word in words:
+            time.sleep(self.delay / len(words))
+            yield word + " "
+
+    async def answer_and_rotate_stream_async(self, prompt: str) -> AsyncIterator[str]:
+        words = self._stub_answer(prompt).split(" ")
+        for word in words:
+            await asyncio.sleep(self.delay / len(words))
+            yield word + " "
@@ -0,0 +1,165 @@
+import json
+import os
+from typing import Callable
+import numpy as np
+
+SENTENCES_SQL = """
+    SELECT sentence_id, section_id, text, embedding
+    FROM sentence
+    WHERE embedding IS NOT NULL
+    ORDER BY section_id, sentence_id
+"""
+# changes with any embedded sentence, its text or its embedding; hashed in the database, so only 32 bytes come back
+FINGERPRINT_SQL = """
+    SELECT md5(string_agg(md5(text || embedding::text), '' ORDER BY section_id, sentence_id))
+    FROM sentence
+    WHERE embedding IS NOT NULL
+"""
+
+
+class VerseMatrix:
+    """
+    The embeddings of every row of the (small, static) Sentence table as one contiguous
+    L2-normalized float32 matrix, with an index from (sentence_id, section_id) to its row.
+    Similarities against a query are a single matrix-vector product, so no database round trip
+    or model inference is needed for verses at query time.
+
+    It can be cached on disk: `<cache_path>.npy` holds the matrix (memory-mapped on load)
+    and `<cache_path>.json` the ids, texts, the model that produced the embeddings and a fingerprint
+    of the rows they were built from
+    """
+
+    def __init__(
+        self,
+        keys: list[tuple[int, int]],
+        texts: list[str],
+        matrix: np.ndarray,
+        model: str = None,
+        fingerprint: str = None,
+    ):
+        self.keys = keys
+        self.texts = texts
+        self.matrix = matrix
+        self.model = model
+        self.fingerprint = fingerprint
+        self.index: dict[tuple[int, int], int] = {
+            key: row for row, key in enumerate(keys)
+        }
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @classmethod
+    def from_rows(
+        cls, rows: list[tuple[int, int, str, np.ndarray]], model: str = None
+    ) -> "VerseMatrix":
+        if not rows:
+            return cls([], [], np.zeros((0, 0), dtype=np.float32), model)
+        keys = [(sentence_id, section_id) for sentence_id, section_id, _, _ in rows]
+        texts = [text for _, _, text, _ in rows]
+        matrix = np.ascontiguousarray(
+            np.stack([np.asarray(embedding, dtype=np.float32) for *_, embedding in rows])
+        )
+        # db/update_tables.py normalizes what it stores, this only guards rows embedded before it did
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        return cls(keys, texts, matrix, model)
+
+    @classmethod
+    def load(
+        cls,
+        fetch: Callable[[str], list[tuple]],
+        cache_path: str = None,
+        model: str = None,
+    ) -> "VerseMatrix":
+        """
+        Loads the matrix from `cache_path` if it is there and still matches the database
+        (same model and fingerprint of the embedded sentences), otherwise builds it with `fetch`
+        (a function running a query and returning its rows) and refreshes the cache
+        """
+        if not cache_path:
+            return cls.from_rows(fetch(SENTENCES_SQL), model)
+        fingerprint = fetch(FINGERPRINT_SQL)[0][0]
+        verses = cls._read_cache(cache_path, model, fingerprint)
+        if verses is None:
+            verses = cls.from_rows(fetch(SENTENCES_SQL), model)
+            verses.fingerprint = fingerprint
+            verses.save(cache_path)
+        return verses
+
+    @classmethod
+    def _read_cache(
+        cls, cache_path: str, model: str, fingerprint: str
+    ) -> "VerseMatrix | None":
+        # anything missing, unreadable or stale is a cache miss
+        try:
+            with open(f"{cache_path}.json", "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("model") != model or meta.get("fingerprint") != fingerprint:
+                return None
+            matrix = np.load(f"{cache_path}.npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        keys = [tuple(key) for key in meta["keys"]]
+        if len(matrix) != len(keys):
+            return None
+        return cls(keys, meta["texts"], matrix, model, fingerprint)
+
+    def save(self, cache_path: str):
+        """
+        Writes both files to temporary names then renames them, the `.json` last, so a process loading
+        the cache at the same time (e.g. another server worker warming up) never reads a partial file
+        """
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        suffix = f".{os.getpid()}.tmp"
+        with open(f"{cache_path}.npy{suffix}", "wb") as f:
+            np.save(f, self.matrix)
+        with open(f"{cache_path}.json{suffix}", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "model": self.model,
+                    "fingerprint": self.fingerprint,
+                    "keys": self.keys,
+                    "texts": self.texts,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(f"{cache_path}.npy{suffix}", f"{cache_path}.npy")
+        os.replace(f"{cache_path}.json{suffix}", f"{cache_path}.json")
+
+    def similarities(self, query_vec: np.ndarray) -> np.ndarray:
+        """
+        Cosine similarity of every verse to the (normalized) query vector, in row order
+        """
+        return self.matrix @ np.asarray(query_vec, dtype=np.float32)
+
+    def similarity_of(
+        self, keys: list[tuple[int, int]], query_vec: np.ndarray
+    ) -> np.ndarray:
+        """
+        Cosine similarity of the given (sentence_id, section_id) verses to the query, NaN for unknown verses
+        """
+        rows = np.array([self.index.get(key, -1) for key in keys], dtype=np.int64)
+        result = np.full(len(keys), np.nan, dtype=np.float32)
+        known = rows >= 0
+        if known.any():
+            result[known] = self.matrix[rows[known]] @ np.asarray(
+                query_vec, dtype=np.float32
+            )
+        return result
+
+    def top_k(
+        self, query_vec: np.ndarray, k: int
+    ) -> list[tuple[int, int, str, float]]:
+        """
+        The `k` most similar verses as (sentence_id, section_id, text, similarity), most similar first
+        """
+        similarities = self.similarities(query_vec)
+        k = min(k, len(similarities))
+        if k <= 0:
+            return []
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [
+            (*self.keys[row], self.texts[row], float(similarities[row])) for row in top
+        ]
@@ -1,15 +1,22 @@
 import flask
 from flask_cors import CORS
-from playground.test import RetrieverBySource, SentenceRelatedTexts
+from playground.pool import PooledRetrieverBySource
+from playground.cache import make_cache
 import json
-from playground.utils import Gemini
+from playground.utils import Gemini, GeminiStub
+from server.sse import HEADERS, sse_event, wants_stream
 import os
+import atexit
 from dotenv import load_dotenv
 
 load_dotenv()
-api_keys = os.getenv("GEMINI_API_KEY").split("|||||")
-
-inference = Gemini(api_keys)
+# the answer cache is opened in `warm_up`, so importing this module creates no files
+if os.getenv("GEMINI_STUB"):
+    # load testing without spending API quota
+    inference = GeminiStub(delay=float(os.getenv("GEMINI_STUB_DELAY", 2)))
+else:
+    api_keys = os.getenv("GEMINI_API_KEY").split("|||||")
+    inference = Gemini(api_keys)
 
 app = flask.Flask(__name__)
 CORS(
@@ -18,8 +25,49 @@ CORS(
     allow_headers=["Content-Type", "Authorization"],
     methods=["GET", "POST", "OPTIONS"],
 )
-retriever = RetrieverBySource()
+# every query checks out its own pooled connection, so the retriever is safe to share between threads/requests
+retriever = PooledRetrieverBySource(
+    cache=make_cache(
+        os.getenv("RESULT_CACHE", "memory"),
+        ttl=float(os.getenv("RESULT_CACHE_TTL", 3600)),
+        max_entries=int(os.getenv("RESULT_CACHE_SIZE", 10_000)),
+        location=os.getenv("RESULT_CACHE_LOCATION"),
+    ),
+    coarse_dim=(
+        int(os.getenv("COARSE_DIM", 256)) if os.getenv("COARSE_SEARCH") == "1" else None
+    ),
+    quantization=os.getenv("QUANTIZED_SEARCH") or None,
+    oversample=int(os.getenv("COARSE_OVERSAMPLE", 4)),
+    # 0: all sources in one UNION ALL statement on one connection instead of one query per source
+    parallel=os.getenv("PARALLEL_RETRIEVAL", "1") == "1",
+)
 DEFAULT_COUNT = 20
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 30))
+
+
+def warm_up():
+    """
+    Loads the model, the sources and the verse embeddings and opens the answer cache before serving.
+    Importing this module does none of it, so without it the first requests pay for the loading (and answers are not cached)
+    """
+    inference.cache = make_cache(
+        os.getenv("ANSWER_CACHE", "sqlite"),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", 7 * 24 * 3600)),
+        max_entries=int(os.getenv("ANSWER_CACHE_SIZE", 50_000)),
+        location=os.getenv("ANSWER_CACHE_LOCATION", "cache/answers.sqlite3"),
+    )
+    retriever.warm_up(os.getenv("VERSE_CACHE_PATH", "cache/verses"))
+
+
+def shutdown():
+    """
+    Waits for in-flight queries to hand their connections back, then closes the pool
+    """
+    if not retriever.close(SHUTDOWN_TIMEOUT):
+        print("Timed out while draining the connection pool.")
+
+
+atexit.register(shutdown)
 
 @app.route("/query-without-inference", methods=["POST"])
 def query():
@@ -62,15 +110,7 @@ def query():
     sources = data.get("sources")
     if not sources:
         sources = retriever.source_ids
-    try:
-        results = retriever.retrieve(query, sources, DEFAULT_COUNT)
-    except Exception as e:
-        # rollback on error
-        try:
-            retriever.conn.rollback()
-        except Exception:
-            pass
-        raise e
+    results = retriever.retrieve(query, sources, DEFAULT_COUNT)
     response = results.to_dict()
     return response, 200
 
@@ -83,25 +123,45 @@ def query_with_inference():
     2. The user query
 
     This endpoint returns a string
+    If `"stream": true` is sent (or `Accept: text/event-stream`), the retrieved data and then
+    the answer chunks are streamed as Server-Sent Events instead (see `server/sse.py`)
     """
     data = flask.request.get_json()
     query: str = data.get("query", "")
     sources: list[str] = data.get("sources", retriever.source_ids)
-    try:
-        results = retriever.retrieve(query, sources, DEFAULT_COUNT)
-    except Exception as e:
-        # rollback on error
-        try:
-            retriever.conn.rollback()
-        except Exception:
-            pass
-        raise e
+    results = retriever.retrieve(query, sources, DEFAULT_COUNT)
     response = results.to_dict()
+    stream = wants_stream(data, flask.request.headers.get("Accept"))
+    if stream:
+        # serialized before the source rewrite below, the event has the `/query-without-inference` shape
+        retrieved = sse_event("retrieval", response)
     for result in response.get("related_texts", []):
         result["source"] = retriever.source_by_id.get(result["source_id"])
         del result["source_id"]
+    json_data = json.dumps(response, ensure_ascii=False, indent=2)
+
+    if stream:
+
+        def generate():
+            yield retrieved
+            chunks: list[str] = []
+            try:
+                for chunk in inference.ask_stream(query, json_data):
+                    chunks.append(chunk)
+                    yield sse_event("token", {"text": chunk})
+            except Exception as e:
+                # the status line is already sent, report the failure in-band
+                yield sse_event("error", {"error": str(e)})
+                return
+            yield sse_event("done", {"response": "".join(chunks)})
+
+        return flask.Response(
+            flask.stream_with_context(generate()),
+            mimetype="text/event-stream",
+            headers=HEADERS,
+        )
 
-    response = inference.ask(query, json.dumps(response, ensure_ascii=False, indent=2))
+    response = inference.ask(query, json_data)
     response = {"response": str(response)}
     return response, 200
 
@@ -114,5 +174,17 @@ def get_sources():
     return {"sources": retriever.sources}, 200
 
 
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """
+    This endpoint returns the hit/miss counters of the result and answer caches of this process.
+    """
+    return {
+        "results": retriever.cache.stats() if retriever.cache else None,
+        "answers": inference.cache.stats() if inference.cache else None,
+    }, 200
+
+
 if __name__ == "__main__":
+    warm_up()
     app.run()
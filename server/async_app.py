@@ -0,0 +1,179 @@
+"""
+asyncio variant of `server/app.py` with the same routes and JSON shapes.
+Retrieval runs on a bounded thread pool (the pooled retriever is thread safe) and the Gemini call is awaited,
+so a request waiting on the LLM does not hold a thread and one process can keep hundreds of them in flight.
+
+    hypercorn server.async_app:app --bind 0.0.0.0:5000 --workers 2
+"""
+import quart
+from quart_cors import cors
+from playground.pool import PooledRetrieverBySource
+from playground.cache import make_cache
+import json
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from playground.utils import Gemini, GeminiStub
+from playground.test import Result
+from server.sse import HEADERS, sse_event, wants_stream
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+# the answer cache is opened in `warm_up`, so importing this module creates no files
+if os.getenv("GEMINI_STUB"):
+    # load testing without spending API quota
+    inference = GeminiStub(delay=float(os.getenv("GEMINI_STUB_DELAY", 2)))
+else:
+    api_keys = os.getenv("GEMINI_API_KEY").split("|||||")
+    inference = Gemini(api_keys)
+
+app = quart.Quart(__name__)
+app = cors(
+    app,
+    allow_origin=["http://localhost:3000"],
+    allow_headers=["Content-Type", "Authorization"],
+    allow_methods=["GET", "POST", "OPTIONS"],
+)
+retriever = PooledRetrieverBySource(
+    cache=make_cache(
+        os.getenv("RESULT_CACHE", "memory"),
+        ttl=float(os.getenv("RESULT_CACHE_TTL", 3600)),
+        max_entries=int(os.getenv("RESULT_CACHE_SIZE", 10_000)),
+        location=os.getenv("RESULT_CACHE_LOCATION"),
+    ),
+    coarse_dim=(
+        int(os.getenv("COARSE_DIM", 256)) if os.getenv("COARSE_SEARCH") == "1" else None
+    ),
+    quantization=os.getenv("QUANTIZED_SEARCH") or None,
+    oversample=int(os.getenv("COARSE_OVERSAMPLE", 4)),
+    # 0: all sources in one UNION ALL statement on one connection instead of one query per source
+    parallel=os.getenv("PARALLEL_RETRIEVAL", "1") == "1",
+)
+# retrieval is blocking (DB + model), so it gets as many threads as there are pooled connections
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=retriever.pool.size, thread_name_prefix="retrieve"
+)
+DEFAULT_COUNT = 20
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 30))
+
+
+async def retrieve(query: str, sources: list[str]) -> Result:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        retrieval_executor, retriever.retrieve, query, sources, DEFAULT_COUNT
+    )
+
+
+@app.before_serving
+async def warm_up():
+    """
+    Loads the model, the sources and the verse embeddings and opens the answer cache before the first request
+    (importing this module does none of it)
+    """
+    loop = asyncio.get_running_loop()
+    inference.cache = await loop.run_in_executor(
+        None,
+        lambda: make_cache(
+            os.getenv("ANSWER_CACHE", "sqlite"),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", 7 * 24 * 3600)),
+            max_entries=int(os.getenv("ANSWER_CACHE_SIZE", 50_000)),
+            location=os.getenv("ANSWER_CACHE_LOCATION", "cache/answers.sqlite3"),
+        ),
+    )
+    await loop.run_in_executor(
+        None, retriever.warm_up, os.getenv("VERSE_CACHE_PATH", "cache/verses")
+    )
+
+
+@app.after_serving
+async def shutdown():
+    """
+    Waits for in-flight queries to hand their connections back, then closes the pool
+    """
+    retrieval_executor.shutdown(wait=True)
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, retriever.close, SHUTDOWN_TIMEOUT):
+        print("Timed out while draining the connection pool.")
+
+
+@app.route("/query-without-inference", methods=["POST"])
+async def query():
+    """
+    Same contract as `/query-without-inference` in `server/app.py`
+    """
+    data = await quart.request.get_json()
+    query = data.get("query", None)
+    if not query:
+        return {"error": "Query is required"}, 400
+    sources = data.get("sources")
+    if not sources:
+        sources = retriever.source_ids
+    results = await retrieve(query, sources)
+    response = results.to_dict()
+    return response, 200
+
+
+@app.route("/query-with-inference", methods=["POST"])
+async def query_with_inference():
+    """
+    Same contract as `/query-with-inference` in `server/app.py`, including the streaming mode
+    """
+    data = await quart.request.get_json()
+    query: str = data.get("query", "")
+    sources: list[str] = data.get("sources", retriever.source_ids)
+    results = await retrieve(query, sources)
+    response = results.to_dict()
+    stream = wants_stream(data, quart.request.headers.get("Accept"))
+    if stream:
+        # serialized before the source rewrite below, the event has the `/query-without-inference` shape
+        retrieved = sse_event("retrieval", response)
+    for result in response.get("related_texts", []):
+        result["source"] = retriever.source_by_id.get(result["source_id"])
+        del result["source_id"]
+    json_data = json.dumps(response, ensure_ascii=False, indent=2)
+
+    if stream:
+
+        async def generate():
+            yield retrieved
+            chunks: list[str] = []
+            try:
+                async for chunk in inference.ask_stream_async(query, json_data):
+                    chunks.append(chunk)
+                    yield sse_event("token", {"text": chunk})
+            except Exception as e:
+                # the status line is already sent, report the failure in-band
+                yield sse_event("error", {"error": str(e)})
+                return
+            yield sse_event("done", {"response": "".join(chunks)})
+
+        return quart.Response(
+            generate(), mimetype="text/event-stream", headers=HEADERS
+        )
+
+    response = await inference.ask_async(query, json_data)
+    response = {"response": str(response)}
+    return response, 200
+
+
+@app.route("/sources", methods=["GET"])
+async def get_sources():
+    """
+    This endpoint returns the list of available source IDs.
+    """
+    return {"sources": retriever.sources}, 200
+
+
+@app.route("/cache-stats", methods=["GET"])
+async def get_cache_stats():
+    """
+    This endpoint returns the hit/miss counters of the result and answer caches of this process.
+    """
+    return {
+        "results": retriever.cache.stats() if retriever.cache else None,
+        "answers": inference.cache.stats() if inference.cache else None,
+    }, 200
+
+
+if __name__ == "__main__":
+    app.run()
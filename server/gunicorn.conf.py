@@ -0,0 +1,25 @@
+# gunicorn -c server/gunicorn.conf.py server.app:app
+import os
+
+bind = f"{os.getenv('SERVER_HOST', '0.0.0.0')}:{os.getenv('SERVER_PORT', 5000)}"
+workers = int(os.getenv("SERVER_WORKERS", 2))
+threads = int(os.getenv("SERVER_THREADS", 16))
+worker_class = "gthread"
+# each worker loads the model and opens its own pool (DB_POOL_SIZE connections), so keep preload off.
+# importing the app is cheap, the loading happens in `post_worker_init`
+preload_app = False
+# LLM calls take seconds, do not kill workers that are waiting on them
+timeout = int(os.getenv("SERVER_TIMEOUT", 120))
+graceful_timeout = int(os.getenv("SHUTDOWN_TIMEOUT", 30))
+
+
+def post_worker_init(worker):
+    from server.app import warm_up
+
+    warm_up()
+
+
+def worker_exit(server, worker):
+    from server.app import shutdown
+
+    shutdown()
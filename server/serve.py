@@ -0,0 +1,41 @@
+"""
+Production entry point for the API server (waitress, works on both Windows and Linux).
+
+    python -m server.serve
+
+Configured through the environment:
+    SERVER_HOST (default 0.0.0.0), SERVER_PORT (default 5000), SERVER_THREADS (default 16)
+
+For several worker processes on Linux, use gunicorn with `server/gunicorn.conf.py` instead.
+"""
+import os
+import signal
+from waitress import create_server
+from server.app import app, shutdown, warm_up
+
+
+def main():
+    host = os.getenv("SERVER_HOST", "0.0.0.0")
+    port = int(os.getenv("SERVER_PORT", 5000))
+    threads = int(os.getenv("SERVER_THREADS", 16))
+    warm_up()
+    server = create_server(app, host=host, port=port, threads=threads)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # waitress only handles Ctrl+C, treat SIGTERM (docker stop, systemd) the same way
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Serving on http://{host}:{port} with {threads} threads")
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    finally:
+        # stop accepting connections, then let in-flight queries finish before closing the pool
+        server.close()
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()
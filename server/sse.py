@@ -0,0 +1,28 @@
+"""
+Server-Sent Events helpers shared by `server/app.py` and `server/async_app.py`.
+
+A streamed `/query-with-inference` response is made of the following events:
+    event: retrieval  data: the retrieved sentences/related texts (same shape as `/query-without-inference`)
+    event: token      data: {"text": "<next chunk of the answer>"}   (repeated)
+    event: done       data: {"response": "<the whole answer>"}
+    event: error      data: {"error": "<message>"}                   (instead of done, if generation fails)
+"""
+import json
+
+HEADERS = {
+    "Cache-Control": "no-cache",
+    # stop reverse proxies (nginx) from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+
+def wants_stream(data: dict, accept: str | None) -> bool:
+    """
+    Streaming is requested with `"stream": true` in the body or an `Accept: text/event-stream` header
+    """
+    return bool(data.get("stream")) or "text/event-stream" in (accept or "")
+
+
+def sse_event(event: str, data: dict) -> str:
+    # json.dumps never emits raw new lines, so the payload always fits in one data line
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"